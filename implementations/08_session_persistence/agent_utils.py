@@ -2,14 +2,81 @@
 Shared utilities extracted from previous tutorials:
 Tool, ToolRegistry, ToolCall, Message, LLMOutput, Session.
 """
+import ast
+import asyncio
+import hashlib
+import inspect
 import json
+import math
+import pickle
+import re
+import sqlite3
+import threading
+import time
 import uuid
 
+from abc import ABC, abstractmethod
 from pathlib import Path
+from collections import OrderedDict, defaultdict
 from datetime import datetime
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Callable, Literal
-from pydantic import BaseModel, Field
+from typing import Callable, ClassVar, Literal
+from pydantic import BaseModel, Field, TypeAdapter
+from pydantic_core import SchemaValidator
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class ToolError(str):
+    """A tool result reporting a failure. Still a plain string to the LLM."""
+
+
+def _call_tool_function(function: Callable, parameters_dict: dict) -> str:
+    # Module-level so it can be pickled and run in a worker process
+    try:
+        tool_response = function(**parameters_dict)
+        return str(tool_response)
+    except Exception as e:
+        error_message = f"Tool call failed: {e}"
+        return ToolError(error_message)
+
+
+async def _acall_tool_function(function: Callable, parameters_dict: dict) -> str:
+    # Async tools wait on an event loop instead of holding a pool thread
+    try:
+        tool_response = await function(**parameters_dict)
+        return str(tool_response)
+    except Exception as e:
+        error_message = f"Tool call failed: {e}"
+        return ToolError(error_message)
+
+
+def _batch_results(tool_responses: list, count: int) -> list[str]:
+    # One result per parameter dict; an exception returned in place of a result fails only that call
+    if len(tool_responses) != count:
+        raise ValueError(f"batch returned {len(tool_responses)} results for {count} calls")
+    return [
+        ToolError(f"Tool call failed: {tool_response}") if isinstance(tool_response, Exception) else str(tool_response)
+        for tool_response in tool_responses
+    ]
+
+
+def _call_batch_function(batch_function: Callable, parameters_dicts: list[dict]) -> list[str]:
+    try:
+        return _batch_results(batch_function(parameters_dicts), len(parameters_dicts))
+    except Exception as e:
+        return [ToolError(f"Tool call failed: {e}")] * len(parameters_dicts)
+
+
+async def _acall_batch_function(batch_function: Callable, parameters_dicts: list[dict]) -> list[str]:
+    try:
+        return _batch_results(await batch_function(parameters_dicts), len(parameters_dicts))
+    except Exception as e:
+        return [ToolError(f"Tool call failed: {e}")] * len(parameters_dicts)
 
 
 @dataclass
@@ -18,59 +85,710 @@ class Tool:
     description: str
     parameters: type[BaseModel]
     function: Callable
+    # Where the tool runs: a pool thread (default), a worker process for
+    # CPU-bound work, or inline in the caller for trivial tools.
+    # Async (coroutine) functions ignore it and always run on an event loop
+    backend: Literal["thread", "process", "inline"] = "thread"
+    # Opt-in result caching; leave off for tools with side effects (e.g. send_email)
+    cache: bool = False
+    cache_ttl: float | None = None
+    # Optional batch implementation: takes a list of parameter dicts, returns one result
+    # (or Exception) per dict in order. Same-tool calls of a step are coalesced into one call
+    batch_function: Callable[[list[dict]], list] | None = None
+    # Seconds to wait for a result before reporting a timeout for the call
+    timeout: float | None = None
+    # Bulkhead: most calls in flight at once, across everything sharing the registry
+    # and within one session. Calls over the limit queue without holding a thread
+    max_concurrency: int | None = None
+    max_concurrency_per_session: int | None = None
+    # Built once by compile(): the JSON schema and the parameter validator
+    _schema: dict | None = field(default=None, init=False, repr=False, compare=False)
+    _validator: SchemaValidator | None = field(default=None, init=False, repr=False, compare=False)
+    _shallow: bool = field(default=True, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.backend == "process" and self.is_async:
+            raise ValueError(f"Tool '{self.name}' is async, it can't use the process backend")
+        if self.backend == "process":
+            try:
+                pickle.dumps((self.function, self.batch_function))
+            except Exception as e:
+                raise ValueError(
+                    f"Tool '{self.name}' uses the process backend, so its function must be "
+                    f"picklable (defined at module level): {e}"
+                )
+
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.function)
+
+    @property
+    def is_batch_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.batch_function)
 
     @classmethod
-    def from_function(cls, function: Callable, parameters: type[BaseModel]) -> "Tool":
+    def from_function(cls, function: Callable, parameters: type[BaseModel], **options) -> "Tool":
+        """Build a tool from a function; `options` sets the remaining fields (backend, cache, ...)."""
         return cls(
             name=function.__name__,
             description=str(function.__doc__),
             parameters=parameters,
             function=function,
+            **options,
         )
 
-    def to_schema(self) -> dict:
-        return {
+    def compile(self):
+        """Precompute the schema and validator; called by ToolRegistry.register."""
+        self._schema = {
             "name": self.name,
             "description": self.description,
             "parameters": self.parameters.model_json_schema()
         }
+        # The model's compiled core validator, skipping the BaseModel.model_validate_json wrapper
+        self._validator = self.parameters.__pydantic_validator__
+        # Nested models ($defs) and extra fields still go through model_dump so the function gets plain dicts
+        self._shallow = (
+            "$defs" not in self._schema["parameters"] and self.parameters.model_config.get("extra") != "allow"
+        )
+
+    def to_schema(self) -> dict:
+        """The tool's JSON schema. Shared between calls, treat it as read-only."""
+        if self._schema is None:
+            self.compile()
+        return self._schema
+
+    def validate(self, parameters_str: str) -> dict:
+        if self._validator is None:
+            self.compile()
+        parameters_obj = self._validator.validate_json(parameters_str)
+        if self._shallow:
+            # A validated model's __dict__ holds exactly its fields: no model_dump round trip
+            return dict(parameters_obj.__dict__)
+        return parameters_obj.model_dump()
 
     def execute(self, parameters_str: str) -> str:
         try:
-            parameters_obj = self.parameters.model_validate_json(parameters_str)
-            parameters_dict = parameters_obj.model_dump()
+            parameters_dict = self.validate(parameters_str)
         except Exception as e:
             error_message = f"Invalid tool call parameters: {e}"
-            return error_message
-        
-        try:
-            tool_response = self.function(**parameters_dict)
-            return str(tool_response)
-        except Exception as e:
-            error_message = f"Tool call failed: {e}"
-            return error_message
+            return ToolError(error_message)
+
+        return self.execute_validated(parameters_dict)
+
+    def execute_validated(self, parameters_dict: dict) -> str:
+        """Run the tool in the calling thread (async tools on a temporary event loop)."""
+        if self.is_async:
+            return asyncio.run(_acall_tool_function(self.function, parameters_dict))
+        return _call_tool_function(self.function, parameters_dict)
+
+    def execute_batch_validated(self, parameters_dicts: list[dict]) -> list[str]:
+        if self.is_batch_async:
+            return asyncio.run(_acall_batch_function(self.batch_function, parameters_dicts))
+        return _call_batch_function(self.batch_function, parameters_dicts)
+
+
+class ToolCache:
+    """
+    LRU cache of tool results with per-entry TTL.
+
+    Shared by everything using the same ToolRegistry (or the same instance
+    passed to several registries), so repeated calls hit across sessions.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[float | None, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(tool_name: str, parameters_dict: dict) -> tuple:
+        # Canonical form of the validated parameters: defaults filled in, keys sorted
+        return tool_name, json.dumps(parameters_dict, sort_keys=True, default=str)
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, result: str, ttl: float | None = None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires_at, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _QueuedToolCall(Future):
+    """A call waiting in a ToolBulkhead; mirrors the real call once that starts."""
+    def __init__(self, start: Callable[[], Future], session_id: str | None):
+        super().__init__()
+        self.start = start
+        self.session_id = session_id
+        self.enqueued_at = time.monotonic()
+        self.inner: Future | None = None
+
+    def cancel(self) -> bool:
+        # Once started, only a cancellable call (queued in its pool, or async) can be cancelled
+        inner = self.inner
+        if inner is not None and not inner.cancel():
+            return False
+        return super().cancel()
+
+
+class ToolBulkhead:
+    """
+    Caps the in-flight calls of one tool, globally and per session, so a slow
+    downstream can't take over the tool pool. Calls over the limit wait in a
+    FIFO queue without holding a thread and start as earlier calls finish; a
+    call held back only by its own session's cap lets other sessions go first.
+    """
+    def __init__(self, max_concurrency: int | None = None, max_concurrency_per_session: int | None = None):
+        self.max_concurrency = max_concurrency
+        self.max_concurrency_per_session = max_concurrency_per_session
+        self._in_flight = 0
+        self._in_flight_by_session: dict[str | None, int] = defaultdict(int)
+        self._queue: list[_QueuedToolCall] = []
+        self._lock = threading.Lock()
+        # Queue wait metric, over every call (immediate starts count as zero wait)
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, start: Callable[[], Future], session_id: str | None = None) -> Future:
+        """Start the call now if a slot is free, else queue it; returns a future of its result."""
+        with self._lock:
+            # Calls of the same session keep their order behind ones already queued
+            if self._has_capacity(session_id) and not any(
+                queued.session_id == session_id for queued in self._queue
+            ):
+                self._acquire(session_id)
+                self._record_wait(0.0)
+                queued = None
+            else:
+                queued = _QueuedToolCall(start, session_id)
+                self._queue.append(queued)
+        if queued is not None:
+            return queued
+        future = start()
+        future.add_done_callback(lambda _: self._release(session_id))
+        return future
+
+    def set_limits(self, max_concurrency: int | None, max_concurrency_per_session: int | None):
+        with self._lock:
+            self.max_concurrency = max_concurrency
+            self.max_concurrency_per_session = max_concurrency_per_session
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._queue),
+                "wait_count": self.wait_count,
+                "wait_total_s": self.wait_total,
+                "wait_avg_s": self.wait_total / self.wait_count if self.wait_count else 0.0,
+                "wait_max_s": self.wait_max,
+            }
+
+    def _has_capacity(self, session_id: str | None) -> bool:
+        if self.max_concurrency is not None and self._in_flight >= self.max_concurrency:
+            return False
+        if self.max_concurrency_per_session is not None:
+            return self._in_flight_by_session[session_id] < self.max_concurrency_per_session
+        return True
+
+    def _acquire(self, session_id: str | None):
+        self._in_flight += 1
+        self._in_flight_by_session[session_id] += 1
+
+    def _record_wait(self, wait: float):
+        self.wait_count += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def _release(self, session_id: str | None):
+        with self._lock:
+            self._in_flight -= 1
+            self._in_flight_by_session[session_id] -= 1
+            if not self._in_flight_by_session[session_id]:
+                del self._in_flight_by_session[session_id]
+            startable, remaining, blocked_sessions = [], [], set()
+            for queued in self._queue:
+                if queued.cancelled():
+                    continue  # timed out while waiting
+                if queued.session_id not in blocked_sessions and self._has_capacity(queued.session_id):
+                    self._acquire(queued.session_id)
+                    self._record_wait(time.monotonic() - queued.enqueued_at)
+                    startable.append(queued)
+                else:
+                    blocked_sessions.add(queued.session_id)
+                    remaining.append(queued)
+            self._queue = remaining
+        for queued in startable:
+            self._start(queued)
+
+    def _start(self, queued: _QueuedToolCall):
+        if queued.cancelled():
+            self._release(queued.session_id)
+            return
+        started_at = time.monotonic()
+        queued.inner = inner = queued.start()
+
+        def forward(inner: Future):
+            # Tracing hooks see the whole wait, bulkhead queue included
+            queued.timing = {"started_at": getattr(inner, "timing", {}).get("started_at", started_at)}
+            try:
+                if inner.cancelled():
+                    Future.cancel(queued)
+                elif inner.exception() is not None:
+                    queued.set_exception(inner.exception())
+                else:
+                    queued.set_result(inner.result())
+            except InvalidStateError:
+                pass  # cancelled meanwhile
+            self._release(queued.session_id)
+        inner.add_done_callback(forward)
+
+
+class ToolIndex(ABC):
+    """
+    Retrieval over the registered tools, so a prompt only carries the ones
+    relevant to the query. ToolRegistry adds each tool at registration;
+    subclass (e.g. with an embedding model) to replace the default BM25.
+    """
+    @abstractmethod
+    def add(self, tool: Tool):
+        ...
+
+    @abstractmethod
+    def search(self, query: str, k: int) -> list[str]:
+        """Names of the (at most) k tools most relevant to the query, best first."""
+
+
+class BM25ToolIndex(ToolIndex):
+    """Okapi BM25 over each tool's name, description and parameter descriptions."""
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {tool name: term frequency}
+        self._postings: dict[str, dict[str, int]] = defaultdict(dict)
+        self._lengths: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text: str) -> list[str]:
+        # Also splits snake_case names: get_weather -> get, weather
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    @staticmethod
+    def _document(tool: Tool) -> str:
+        properties = tool.to_schema()["parameters"].get("properties", {})
+        fields = " ".join(f"{name} {field.get('description', '')}" for name, field in properties.items())
+        # The name counts twice: it is the strongest hint of what a tool does
+        return f"{tool.name} {tool.name} {tool.description} {fields}"
+
+    def add(self, tool: Tool):
+        terms = self.tokenize(self._document(tool))
+        with self._lock:
+            for postings in self._postings.values():
+                postings.pop(tool.name, None)  # re-registration replaces the old entry
+            for term in set(terms):
+                self._postings[term][tool.name] = terms.count(term)
+            self._lengths[tool.name] = len(terms)
+
+    def search(self, query: str, k: int) -> list[str]:
+        with self._lock:
+            if not self._lengths:
+                return []
+            tool_count = len(self._lengths)
+            average_length = sum(self._lengths.values()) / tool_count
+            scores: dict[str, float] = defaultdict(float)
+            for term in set(self.tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (tool_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for name, frequency in postings.items():
+                    length_norm = 1 - self.b + self.b * self._lengths[name] / average_length
+                    scores[name] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [name for name, _ in ranked[:k]]
+
+
+class SearchToolsParameters(BaseModel):
+    query: str = Field(description="what the tool should do, in a few words")
+    k: int = Field(default=5, gt=0, description="number of tools to return")
 
 
 class ToolRegistry:
-    def __init__(self):
+    def __init__(
+            self, cache: ToolCache | None = None, index: ToolIndex | None = None,
+            bulkheads: dict[str, ToolBulkhead] | None = None
+        ):
         self._tools: dict[str, Tool] = {}
+        self._cache = cache
+        self._index = index
+        self._schemas: list[dict] | None = None
+        # Bulkheads by tool name; pass the same dict to registries (agents) sharing a downstream
+        # so a tool's limits hold across all of them
+        self._bulkheads = bulkheads if bulkheads is not None else {}
+        self._limited_tools: set[str] = set()
 
-    def register(self, tool: Tool):
+    def register(self, tool: Tool, indexed: bool = True):
+        """Add a tool; `indexed=False` keeps it out of the search index (e.g. always-present meta-tools)."""
+        tool.compile()
         self._tools[tool.name] = tool
+        self._schemas = None
+        if indexed and self._index is not None:
+            self._index.add(tool)
+        if tool.max_concurrency is not None or tool.max_concurrency_per_session is not None:
+            bulkhead = self._bulkheads.setdefault(tool.name, ToolBulkhead())
+            bulkhead.set_limits(tool.max_concurrency, tool.max_concurrency_per_session)
+            self._limited_tools.add(tool.name)
+        else:
+            # The bulkhead may be shared, other registries can still be using it
+            self._limited_tools.discard(tool.name)
+
+    def bulkhead_stats(self) -> dict[str, dict]:
+        """In-flight, queued and queue-wait figures of every tool with a concurrency limit."""
+        return {name: self._bulkheads[name].stats() for name in self._limited_tools}
 
     def execute(self, name: str, parameters: str) -> str:
-        if name in self._tools:
-            return self._tools[name].execute(parameters)
-        else:
+        return self.submit(name, parameters).result()
+
+    def get(self, name: str) -> Tool | None:
+        return self._tools.get(name)
+
+    def submit(
+            self, name: str, parameters: str, executor: "ToolExecutor | None" = None,
+            loop: asyncio.AbstractEventLoop | None = None, session_id: str | None = None
+        ) -> Future:
+        """
+        Start a tool call on the tool's execution backend, returning a future
+        of its result. Without an executor the tool runs inline. Async tools
+        run on `loop` when given (the caller's loop), else on the executor's.
+        `session_id` is what the tool's per-session concurrency limit counts by.
+        """
+        tool, parameters_dict, cache_key, completed = self._prepare(name, parameters)
+        if completed is not None:
+            return completed
+
+        def start() -> Future:
+            if executor is None:
+                return ToolExecutor.completed(tool.execute_validated(parameters_dict))
+            return executor.submit_tool(tool, parameters_dict, loop)
+        future = self._start_limited(name, start, session_id)
+        self._store_on_done(tool, future, cache_key)
+        return future
+
+    def _start_limited(self, name: str, start: Callable[[], Future], session_id: str | None) -> Future:
+        bulkhead = self._bulkheads.get(name) if name in self._limited_tools else None
+        return start() if bulkhead is None else bulkhead.submit(start, session_id)
+
+    def submit_batch(
+            self, name: str, parameters_list: list[str], executor: "ToolExecutor | None" = None,
+            loop: asyncio.AbstractEventLoop | None = None, session_id: str | None = None
+        ) -> list[Future]:
+        """
+        Start several calls of one tool, returning a future per call in order.
+        Calls that miss the cache go to the tool's batch_function in a single
+        invocation (one concurrency slot); tools without one fall back to one
+        submit() per call.
+        """
+        tool = self._tools.get(name)
+        if tool is None or tool.batch_function is None or len(parameters_list) < 2:
+            return [self.submit(name, parameters, executor, loop, session_id) for parameters in parameters_list]
+
+        futures: list[Future] = []
+        pending: list[tuple[Future, dict, tuple | None]] = []
+        for parameters in parameters_list:
+            _, parameters_dict, cache_key, completed = self._prepare(name, parameters)
+            if completed is None:
+                completed = Future()
+                pending.append((completed, parameters_dict, cache_key))
+                self._store_on_done(tool, completed, cache_key)
+            futures.append(completed)
+        if not pending:
+            return futures
+
+        parameters_dicts = [parameters_dict for _, parameters_dict, _ in pending]
+
+        def start() -> Future:
+            if executor is None:
+                return ToolExecutor.completed(tool.execute_batch_validated(parameters_dicts))
+            return executor.submit_tool_batch(tool, parameters_dicts, loop)
+        batch_future = self._start_limited(name, start, session_id)
+
+        def scatter(batch_future: Future):
+            for index, (future, _, _) in enumerate(pending):
+                # Queueing delay of the shared batch call, for tracing hooks
+                future.timing = getattr(batch_future, "timing", {})
+                if future.cancelled():
+                    continue  # timed out, the result is dropped
+                elif batch_future.cancelled():
+                    future.cancel()
+                elif batch_future.exception() is not None:
+                    future.set_exception(batch_future.exception())
+                else:
+                    future.set_result(batch_future.result()[index])
+        batch_future.add_done_callback(scatter)
+        return futures
+
+    def _prepare(self, name: str, parameters: str) -> tuple[Tool | None, dict | None, tuple | None, Future | None]:
+        """Validate and look up the cache; the last item is a finished future when no backend call is needed."""
+        if name not in self._tools:
             error_message = f"Tool '{name}' not registered"
-            return error_message
+            return None, None, None, ToolExecutor.completed(ToolError(error_message))
+        tool = self._tools[name]
+
+        try:
+            parameters_dict = tool.validate(parameters)
+        except Exception as e:
+            error_message = f"Invalid tool call parameters: {e}"
+            return tool, None, None, ToolExecutor.completed(ToolError(error_message))
+
+        cache_key = None
+        if tool.cache and self._cache is not None:
+            cache_key = ToolCache.make_key(name, parameters_dict)
+            cached_result = self._cache.get(cache_key)
+            if cached_result is not None:
+                return tool, parameters_dict, cache_key, ToolExecutor.completed(cached_result)
+        return tool, parameters_dict, cache_key, None
+
+    def _store_on_done(self, tool: Tool, future: Future, cache_key: tuple | None):
+        if cache_key is None:
+            return
+
+        def store(future: Future):
+            # Failures are not cached, the next call retries the backend
+            if not future.cancelled() and future.exception() is None and not isinstance(future.result(), ToolError):
+                self._cache.put(cache_key, future.result(), ttl=tool.cache_ttl)
+        future.add_done_callback(store)
+
+    def search(self, query: str, k: int) -> list[str]:
+        """Names of the k registered tools most relevant to the query (none without an index)."""
+        if self._index is None:
+            return []
+        return [name for name in self._index.search(query, k) if name in self._tools]
+
+    def to_schemas(self, names: list[str] | None = None) -> list[dict]:
+        """
+        Schemas of all registered tools (rebuilt only after register()), or of
+        just the named ones. Treat as read-only.
+        """
+        if names is not None:
+            return [self._tools[name].to_schema() for name in names if name in self._tools]
+        if self._schemas is None:
+            self._schemas = [
+                self._tools[tool_name].to_schema()
+                for tool_name in sorted(self._tools)
+            ]
+        return self._schemas
+
+
+class ToolExecutor:
+    """
+    A long-lived pool for tool calls.
+
+    Owned by one Agent or shared between several, so threads are started once
+    and the total number of concurrent tool calls stays bounded under load.
+    Process-backed tools run in a separate process pool, created on first use
+    and kept warm afterwards.
+    """
+    def __init__(self, max_workers: int | None = None, max_processes: int | None = None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._max_processes = max_processes
+        self._process_executor: ProcessPoolExecutor | None = None
+        # Calls in flight in each process pool, and the calls given up on in retired pools
+        self._process_calls: dict[ProcessPoolExecutor, set[Future]] = {}
+        self._abandoned_calls: dict[ProcessPoolExecutor, set[Future]] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+
+    @property
+    def max_workers(self) -> int:
+        return self._executor._max_workers
+
+    @property
+    def queue_depth(self) -> int:
+        """Tool calls submitted but still waiting for a free worker."""
+        return self._queued
+
+    @property
+    def in_flight(self) -> int:
+        """Tool calls currently running on a worker."""
+        return self._running
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        timing = {}
+
+        def run():
+            timing["started_at"] = time.monotonic()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        with self._lock:
+            self._queued += 1
+        future = self._executor.submit(run)
+        # Read once the future is done, to tell queueing delay apart from run time
+        future.timing = timing
+        future.add_done_callback(self._on_done)
+        return future
+
+    def submit_tool(self, tool: Tool, parameters_dict: dict, loop: asyncio.AbstractEventLoop | None = None) -> Future:
+        """
+        Run an already-validated tool call on the tool's backend. Async tools
+        run as tasks on `loop`, or on the executor's own loop thread.
+        """
+        if tool.is_async:
+            return self.submit_coroutine(_acall_tool_function(tool.function, parameters_dict), loop)
+        elif tool.backend == "inline":
+            return self.completed(_call_tool_function(tool.function, parameters_dict))
+        elif tool.backend == "process":
+            # Only the plain parameter dict crosses the process boundary
+            return self._submit_process(_call_tool_function, tool.function, parameters_dict)
+        else:
+            return self.submit(_call_tool_function, tool.function, parameters_dict)
+
+    def submit_tool_batch(
+            self, tool: Tool, parameters_dicts: list[dict], loop: asyncio.AbstractEventLoop | None = None
+        ) -> Future:
+        """Run a tool's batch_function once for several validated calls; the future holds the result list."""
+        if tool.is_batch_async:
+            return self.submit_coroutine(_acall_batch_function(tool.batch_function, parameters_dicts), loop)
+        elif tool.backend == "inline":
+            return self.completed(_call_batch_function(tool.batch_function, parameters_dicts))
+        elif tool.backend == "process":
+            return self._submit_process(_call_batch_function, tool.batch_function, parameters_dicts)
+        else:
+            return self.submit(_call_batch_function, tool.batch_function, parameters_dicts)
+
+    def submit_coroutine(self, coroutine, loop: asyncio.AbstractEventLoop | None = None) -> Future:
+        """
+        Schedule a coroutine on `loop` (e.g. the caller's running loop) or on the
+        executor's loop thread. Waiting calls hold no thread, and cancelling the
+        returned future cancels the task.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, loop or self._get_event_loop())
+
+    @staticmethod
+    def completed(result) -> Future:
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def terminate_process_call(self, future: Future):
+        """
+        Stop a running process-backed call, e.g. a hung one. Its pool is retired:
+        new calls go to a fresh pool, and the retired workers are killed once
+        every other call running there has finished, so only the calls given up
+        on fail.
+        """
+        if isinstance(future, _QueuedToolCall):
+            future = future.inner
+        with self._lock:
+            pool = next((pool for pool, calls in self._process_calls.items() if future in calls), None)
+            if pool is None:
+                return  # already finished, or not a process call
+            if pool is self._process_executor:
+                self._process_executor = None
+            self._abandoned_calls.setdefault(pool, set()).add(future)
+        self._reap_process_pool(pool)
+
+    def _get_event_loop(self) -> asyncio.AbstractEventLoop:
+        # One loop thread serves every async tool call of a sync agent
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="tool-loop", daemon=True)
+                self._loop_thread.start()
+            return self._loop
 
+    def _submit_process(self, function: Callable, *args) -> Future:
+        with self._lock:
+            if self._process_executor is None:
+                self._process_executor = ProcessPoolExecutor(max_workers=self._max_processes)
+            pool = self._process_executor
+            future = pool.submit(function, *args)
+            self._process_calls.setdefault(pool, set()).add(future)
+        future.add_done_callback(lambda future: self._on_process_call_done(pool, future))
+        return future
 
-    def to_schemas(self) -> list[dict]:
-        return [
-            self._tools[tool_name].to_schema()
-            for tool_name in sorted(self._tools)
-        ]
+    def _on_process_call_done(self, pool: ProcessPoolExecutor, future: Future):
+        with self._lock:
+            self._process_calls.get(pool, set()).discard(future)
+        self._reap_process_pool(pool)
+
+    def _reap_process_pool(self, pool: ProcessPoolExecutor, force: bool = False):
+        """Kill a retired pool's workers once only abandoned calls are left running in it."""
+        with self._lock:
+            abandoned = self._abandoned_calls.get(pool)
+            if abandoned is None or not (force or self._process_calls.get(pool, set()) <= abandoned):
+                return
+            del self._abandoned_calls[pool]
+            self._process_calls.pop(pool, None)
+        # ProcessPoolExecutor has no public way to stop a running worker
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _on_done(self, future: Future):
+        # A call cancelled before it started never ran `run`, so it is still counted as queued
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+        if self._process_executor is not None:
+            self._process_executor.shutdown(wait=wait)
+        for pool in list(self._abandoned_calls):
+            self._reap_process_pool(pool, force=True)
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._finish_tasks(cancel=not wait), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._loop = None
+
+    @staticmethod
+    async def _finish_tasks(cancel: bool):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if cancel:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self) -> "ToolExecutor":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+# {{<call id>.result}} or {{<call id>.result.<key>...}} inside tool call parameters
+RESULT_REFERENCE = re.compile(r"\{\{\s*([^{}\s.]+)\.result((?:\.[^{}\s.]+)*)\s*\}\}")
 
 
 class ToolCall(BaseModel):
@@ -79,6 +797,60 @@ class ToolCall(BaseModel):
     type: Literal["tool_call"] = "tool_call"
     name: str = Field(description="name of the tool call")
     parameters: str = Field(description="parameters of the tool with format matching tool's parameters definition")
+    depends_on: list[str] = Field(
+        default_factory=list,
+        description="ids of other tool calls in this reply that must finish first. Use a result in parameters as "
+                    "{{<id>.result}}, or a field of a JSON result as {{<id>.result.<field>}}"
+    )
+
+    @property
+    def dependencies(self) -> list[str]:
+        """depends_on plus every call referenced in the parameters."""
+        referenced = [match.group(1) for match in RESULT_REFERENCE.finditer(self.parameters)]
+        return list(dict.fromkeys(self.depends_on + referenced))
+
+    def resolve(self, results: dict[str, str]) -> "ToolCall":
+        """
+        Substitute result references with the results of finished calls. A
+        parameter that is exactly one reference takes the referenced value
+        as-is (e.g. a number field); otherwise it is formatted into the string.
+        """
+        if not RESULT_REFERENCE.search(self.parameters):
+            return self
+        try:
+            parameters = json.loads(self.parameters)
+        except json.JSONDecodeError:
+            return self  # reported by parameter validation
+
+        def lookup(match: re.Match):
+            value = results[match.group(1)]
+            for key in filter(None, match.group(2).split(".")):
+                if isinstance(value, str):
+                    value = _parse_result(value)
+                value = value[int(key)] if isinstance(value, list) else value[key]
+            return value
+
+        def substitute(value):
+            if isinstance(value, str):
+                match = RESULT_REFERENCE.fullmatch(value.strip())
+                if match:
+                    return lookup(match)
+                return RESULT_REFERENCE.sub(lambda match: str(lookup(match)), value)
+            if isinstance(value, dict):
+                return {key: substitute(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [substitute(item) for item in value]
+            return value
+
+        return self.model_copy(update={"parameters": json.dumps(substitute(parameters))})
+
+
+def _parse_result(result: str):
+    # Tool results are str() of the return value: JSON, or the repr of a dict/list
+    try:
+        return json.loads(result)
+    except json.JSONDecodeError:
+        return ast.literal_eval(result)
 
 
 class Message(BaseModel):
@@ -100,36 +872,441 @@ class LLMOutput(BaseModel):
     content: list[Message | ToolCall] = Field(description="a list of responses - each response is either a message or function call")
 
 
+
+class LLMOutputStreamParser:
+    """
+    Incremental parser for a streamed LLMOutput JSON document.
+
+    Feed it text chunks as they arrive; it tracks JSON nesting (skipping
+    braces inside strings) and returns each item of the `content` array as
+    soon as its object closes, so tool calls can start before the LLM is done.
+    The full output should still be validated with LLMOutput once complete.
+    """
+    _item_adapter = TypeAdapter(Message | ToolCall)
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._item_chars: list[str] | None = None
+
+    def feed(self, chunk: str) -> list[Message | ToolCall]:
+        items = []
+        for char in chunk:
+            if self._item_chars is not None:
+                self._item_chars.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                # depth 0: outside, 1: root object, 2: the `content` array
+                if char == "{" and self._depth == 2:
+                    self._item_chars = [char]
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._depth == 2 and self._item_chars is not None:
+                    item = self._parse_item("".join(self._item_chars))
+                    if item is not None:
+                        items.append(item)
+                    self._item_chars = None
+        return items
+
+    def _parse_item(self, item_json: str) -> Message | ToolCall | None:
+        try:
+            return self._item_adapter.validate_json(item_json)
+        except Exception:
+            # Leave it to the final LLMOutput validation to report the error
+            return None
+
+
+
+class CompletionStreamAccumulator:
+    """
+    Rebuilds an assistant message from streamed chat completion chunks.
+
+    `feed` returns the tool calls completed by each chunk: in prompt mode they
+    are parsed from the LLMOutput JSON text, in native mode a tool call is
+    complete once the stream moves on to the next one. `finish` returns any
+    tool calls still open when the stream ends.
+    """
+    def __init__(self, native_tools: bool = False):
+        self.native_tools = native_tools
+        self.usage = None
+        self._chunks: list[str] = []
+        self._parser = LLMOutputStreamParser()
+        self._tool_calls: dict[int, dict] = {}
+        self._completed = 0
+
+    def feed(self, chunk) -> list[ToolCall]:
+        if chunk.usage:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return []
+
+        delta = chunk.choices[0].delta
+        completed = []
+        if delta.content:
+            self._chunks.append(delta.content)
+            if not self.native_tools:
+                completed += [item for item in self._parser.feed(delta.content) if isinstance(item, ToolCall)]
+        for tool_call_delta in (delta.tool_calls or []) if self.native_tools else []:
+            tool_call = self._tool_calls.setdefault(
+                tool_call_delta.index, dict(id="", type="function", function=dict(name="", arguments=""))
+            )
+            tool_call["id"] += tool_call_delta.id or ""
+            if tool_call_delta.function:
+                tool_call["function"]["name"] += tool_call_delta.function.name or ""
+                tool_call["function"]["arguments"] += tool_call_delta.function.arguments or ""
+            # Deltas arrive in index order, so a new index closes every earlier one
+            completed += self._complete_tool_calls(up_to=tool_call_delta.index)
+        return completed
+
+    def finish(self) -> list[ToolCall]:
+        return self._complete_tool_calls(up_to=len(self._tool_calls))
+
+    def _complete_tool_calls(self, up_to: int) -> list[ToolCall]:
+        completed = []
+        while self._completed < up_to and self._completed in self._tool_calls:
+            completed.append(native_to_tool_call(self._tool_calls[self._completed]))
+            self._completed += 1
+        return completed
+
+    def message(self) -> dict:
+        message = dict(role="assistant", content="".join(self._chunks))
+        if self._tool_calls:
+            message["tool_calls"] = [self._tool_calls[index] for index in sorted(self._tool_calls)]
+        return message
+
+
+def native_to_tool_call(native_tool_call: dict) -> ToolCall:
+    """Convert a provider `tool_calls` entry into our ToolCall."""
+    return ToolCall(
+        id=native_tool_call["id"],
+        name=native_tool_call["function"]["name"],
+        parameters=native_tool_call["function"]["arguments"] or "{}",
+    )
+
+
+class CompletionCache:
+    """
+    Cache of LLM completions keyed on a hash of (model, messages, parameters).
+
+    Two tiers: an in-memory LRU, and optionally a directory on disk so cached
+    completions survive restarts (e.g. across regression runs). Entries hold
+    the assistant message and its usage, as plain JSON.
+    """
+    def __init__(self, max_size: int = 256, cache_dir: str | None = None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict], **parameters) -> str:
+        request = dict(model=model, messages=messages, parameters=parameters)
+        request_json = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(request_json.encode()).hexdigest()
+
+    def _cache_file(self, key: str) -> Path:
+        return Path(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> dict | None:
+        entry = self._get_memory(key)
+        return entry if entry is not None else self._get_disk(key)
+
+    def put(self, key: str, message: dict, usage: dict | None):
+        entry = dict(message=message, usage=usage)
+        self._put_memory(key, entry)
+        if self.cache_dir is not None:
+            self._put_disk(key, entry)
+
+    async def aget(self, key: str) -> dict | None:
+        """get() for async callers: the disk tier is read in a thread, off the event loop."""
+        entry = self._get_memory(key)
+        if entry is not None:
+            return entry
+        if self.cache_dir is None:
+            return self._get_disk(key)
+        return await asyncio.to_thread(self._get_disk, key)
+
+    async def aput(self, key: str, message: dict, usage: dict | None):
+        entry = dict(message=message, usage=usage)
+        self._put_memory(key, entry)
+        if self.cache_dir is not None:
+            await asyncio.to_thread(self._put_disk, key, entry)
+
+    def _get_memory(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def _get_disk(self, key: str) -> dict | None:
+        if self.cache_dir is not None and self._cache_file(key).exists():
+            with open(self._cache_file(key)) as f:
+                entry = json.load(f)
+            self._put_memory(key, entry)
+            with self._lock:
+                self.hits += 1
+            return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_disk(self, key: str, entry: dict):
+        cache_file = self._cache_file(key)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(entry, f)
+        tmp_file.replace(cache_file)
+
+    def _put_memory(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class ReadToolResultParameters(BaseModel):
+    handle: str = Field(description="handle of a stored tool result, as given in its preview")
+    offset: int = Field(default=0, ge=0, description="character offset to start reading from")
+    limit: int = Field(default=2000, gt=0, description="number of characters to read")
+
+
+class ResultStore:
+    """
+    Keeps large tool results out of the session. Results over
+    `max_inline_chars` are written to `store_dir` under the sha256 of their
+    content (identical results are stored once), and the session gets a
+    preview plus the handle. The read_tool_result tool pages through them.
+    """
+    def __init__(self, store_dir: str = "./tool_results", max_inline_chars: int = 4000, preview_chars: int = 1000):
+        self.store_dir = store_dir
+        self.max_inline_chars = max_inline_chars
+        self.preview_chars = preview_chars
+
+    def _blob_file(self, handle: str) -> Path:
+        if not re.fullmatch(r"[0-9a-f]{64}", handle):
+            raise KeyError(f"Invalid result handle '{handle}'")
+        return Path(self.store_dir, handle[:2], f"{handle}.txt")
+
+    def put(self, text: str) -> str:
+        handle = hashlib.sha256(text.encode()).hexdigest()
+        blob_file = self._blob_file(handle)
+        if not blob_file.exists():
+            blob_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = blob_file.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_file, "w") as f:
+                f.write(text)
+            tmp_file.replace(blob_file)
+        return handle
+
+    def get(self, handle: str) -> str:
+        blob_file = self._blob_file(handle)
+        if not blob_file.exists():
+            raise KeyError(f"No stored result with handle '{handle}'")
+        with open(blob_file) as f:
+            return f.read()
+
+    def spill(self, result: str) -> str:
+        """The result itself if small enough, else a preview pointing at the stored blob."""
+        if len(result) <= self.max_inline_chars:
+            return result
+        handle = self.put(result)
+        preview = (
+            f"{result[:self.preview_chars]}\n"
+            f"[Truncated: showing {self.preview_chars} of {len(result)} characters. The full result is stored "
+            f"with handle '{handle}', call read_tool_result to read more.]"
+        )
+        # Failures stay recognizable as failures
+        return ToolError(preview) if isinstance(result, ToolError) else preview
+
+    def read(self, handle: str, offset: int = 0, limit: int = 2000) -> str:
+        """read a page of a stored tool result by its handle
+        """
+        text = self.get(handle)
+        # Pages (plus this header) always fit inline, so reading never spills again
+        end = min(len(text), offset + min(limit, self.max_inline_chars - 64))
+        return f"[Characters {offset}-{end} of {len(text)}]\n{text[offset:end]}"
+
+    def as_tool(self) -> Tool:
+        return Tool(
+            name="read_tool_result",
+            description=str(self.read.__doc__),
+            parameters=ReadToolResultParameters,
+            function=self.read,
+            # Reads a file: on the tool pool, so it never blocks arun()'s event loop
+            backend="thread",
+        )
+
+
+class PromptEncoder:
+    """
+    How structured data is written into prompts: tool schemas, the output
+    schema and tool results. Whitespace is billed as prompt tokens on every
+    step for the life of the session, so the compact styles trade
+    readability for a smaller prompt.
+
+    - "pretty": indented JSON
+    - "minified": JSON without whitespace
+    - "lines": one line per item as `key: value | key: value`, nested values as minified JSON
+    """
+    def __init__(self, style: Literal["pretty", "minified", "lines"] = "pretty"):
+        self.style = style
+
+    def encode(self, value) -> str:
+        if self.style == "pretty":
+            return json.dumps(value, indent=2)
+        elif self.style == "minified":
+            return self._minified(value)
+        elif isinstance(value, list):
+            return "\n".join(self._encode_line(item) for item in value)
+        elif isinstance(value, dict):
+            return "\n".join(f"{key}: {self._encode_value(item)}" for key, item in value.items())
+        return self._encode_value(value)
+
+    @staticmethod
+    def _minified(value) -> str:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+    def _encode_line(self, item) -> str:
+        if isinstance(item, dict):
+            return " | ".join(f"{key}: {self._encode_value(value)}" for key, value in item.items())
+        return self._encode_value(item)
+
+    def _encode_value(self, value) -> str:
+        # Plain strings go in as-is unless they would break the line structure
+        if isinstance(value, str):
+            value = value.strip()
+            if "\n" not in value and "|" not in value:
+                return value
+        return self._minified(value)
+
+
+
+class TokenCounter:
+    """
+    Local prompt token estimate, so the agent can check the context size
+    before paying for a call. Uses tiktoken when installed, otherwise falls
+    back to roughly four characters per token.
+    """
+    # Per-message overhead of the chat format (role, separators)
+    tokens_per_message = 3
+
+    def __init__(self, model: str = "gpt-4o"):
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = self._load_encoding(model)
+            except Exception as e:
+                # tiktoken downloads encodings on first use, which fails offline
+                print(f"Warning: could not load a tiktoken encoding, estimating ~4 chars/token: {e}")
+
+    @staticmethod
+    def _load_encoding(model: str):
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+
+    def count_text(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def count_message(self, message: dict) -> int:
+        tokens = self.tokens_per_message
+        for key, value in message.items():
+            tokens += self.count_text(value if isinstance(value, str) else json.dumps(value))
+        return tokens
+
+
 @dataclass
 class Session:
     id: str = field(default_factory=lambda: str(uuid.uuid4()))
     _messages: list[dict] = field(default_factory=list)
+    # Token count of each message, filled lazily by count_tokens
+    _token_counts: list[int] = field(default_factory=list, init=False, repr=False, compare=False)
 
-    def add_message(self, role, content):
-        self._messages.append(dict(role=role, content=content))
+    def add_message(self, role, content, **fields):
+        # Extra fields carry native tool calling data (tool_calls, tool_call_id)
+        self._messages.append(dict(role=role, content=content, **fields))
 
     def set_messages(self, messages: list[dict]):
         self._messages = messages
+        self._token_counts = []
+
+    def count_tokens(self, counter: TokenCounter) -> int:
+        """Estimated tokens of all messages; only messages added since the last call are counted."""
+        for message in self._messages[len(self._token_counts):]:
+            self._token_counts.append(counter.count_message(message))
+        return sum(self._token_counts)
 
     def get_messages(self) -> list[dict]:
         return list(self._messages)
+
+    # Async variants used by Agent.arun. In-memory sessions never block, so these
+    # call straight through; persistent sessions move their I/O off the event loop.
+    async def aadd_message(self, role, content, **fields):
+        self.add_message(role, content, **fields)
+
+    async def aset_messages(self, messages: list[dict]):
+        self.set_messages(messages)
     
 @dataclass(kw_only=True)
 class FileSession(Session):
+    """
+    Session persisted to `session_dir`.
+
+    Two storage modes:
+    - "json": the whole session is rewritten to `{id}.json` on every mutation
+    - "jsonl": an append-only log `{id}.jsonl`, one record per mutation, so
+      adding a message costs O(1) bytes written instead of O(N)
+    """
     session_dir: str
     id: str = field(default_factory=lambda: str(uuid.uuid4()))
     created_at: datetime = field(default_factory=lambda: datetime.now())
+    storage: Literal["json", "jsonl"] = "json"
     _messages: list[dict] = field(default_factory=list)
 
     def __post_init__(self):
         self.save()
 
+    @property
+    def session_file(self) -> Path:
+        return Path(self.session_dir, f"{self.id}.{self.storage}")
+
     def save(self):
-        session_json = self.asjson()
-        session_file = Path(self.session_dir, f"{self.id}.json")
+        session_file = self.session_file
         session_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(session_file, 'w') as f:
-            f.write(session_json)
+        if self.storage == "jsonl":
+            # A full save of the log is itself a compaction: header + one snapshot record
+            records = [self._header_record(), dict(op="set_messages", messages=self._messages)]
+            session_str = "".join(json.dumps(record) + "\n" for record in records)
+        else:
+            session_str = self.asjson()
+
+        tmp_file = session_file.with_suffix(session_file.suffix + ".tmp")
+        with open(tmp_file, 'w') as f:
+            f.write(session_str)
+        tmp_file.replace(session_file)
 
     def asjson(self):
         session = {
@@ -139,32 +1316,370 @@ class FileSession(Session):
         }
         return json.dumps(session)
 
+    def _header_record(self) -> dict:
+        return dict(op="header", id=self.id, created_at=self.created_at.isoformat())
+
+    def _append_record(self, record: dict):
+        with open(self.session_file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    @staticmethod
+    def _replay(session_file: Path) -> tuple[datetime, list[dict]]:
+        created_at, messages = None, []
+        with open(session_file) as f:
+            lines = f.readlines()
+
+        for line_no, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line means the process died mid-append: drop it
+                if line_no == len(lines) - 1:
+                    break
+                raise
+
+            if record["op"] == "header":
+                created_at = datetime.fromisoformat(record["created_at"])
+            elif record["op"] == "add_message":
+                messages.append(record["message"])
+            elif record["op"] == "set_messages":
+                messages = record["messages"]
+
+        if created_at is None:
+            raise ValueError(f"Session file {session_file} has no header record.")
+        return created_at, messages
+
     @classmethod
-    def load(cls, session_id: str, session_dir: str) -> "FileSession":
-        session_file = Path(session_dir, f"{session_id}.json")
+    def load(
+            cls, session_id: str, session_dir: str, storage: Literal["json", "jsonl"] | None = None
+        ) -> "FileSession":
+        if storage is None:
+            # Prefer the log if both exist, it is the one being appended to
+            storage = "jsonl" if Path(session_dir, f"{session_id}.jsonl").exists() else "json"
+        session_file = Path(session_dir, f"{session_id}.{storage}")
 
         if not session_file.exists():
             raise FileNotFoundError(f"Session file {session_file} does not exist.")
 
-        with open(session_file) as f:
-            session = json.load(f)
-        created_at = datetime.fromisoformat(session["created_at"])
-        messages = session["messages"]
+        if storage == "jsonl":
+            created_at, messages = cls._replay(session_file)
+        else:
+            with open(session_file) as f:
+                session = json.load(f)
+            created_at = datetime.fromisoformat(session["created_at"])
+            messages = session["messages"]
 
-        return cls(session_dir=session_dir, id=session_id, created_at=created_at, _messages=messages)
+        return cls(
+            session_dir=session_dir, id=session_id, created_at=created_at,
+            storage=storage, _messages=messages
+        )
 
     @classmethod
     def list_sessions(cls, session_dir: str) -> list:
-        session_ids = []
-        for session_file in Path(session_dir).glob("*.json"):
-            session_ids.append(session_file.name)
-        
-        return session_ids
-
-    def add_message(self, role, content):
-        super().add_message(role, content)
-        self.save()
+        session_ids = set()
+        for pattern in ("*.json", "*.jsonl"):
+            for session_file in Path(session_dir).glob(pattern):
+                session_ids.add(session_file.stem)
+
+        return sorted(session_ids)
+
+    def add_message(self, role, content, **fields):
+        super().add_message(role, content, **fields)
+        if self.storage == "jsonl":
+            self._append_record(dict(op="add_message", message=self._messages[-1]))
+        else:
+            self.save()
 
     def set_messages(self, messages: list[dict]):
         super().set_messages(messages)
-        self.save()
\ No newline at end of file
+        if self.storage == "jsonl":
+            # Compaction marker: replay resets the message list at this record
+            self._append_record(dict(op="set_messages", messages=self._messages))
+        else:
+            self.save()
+
+    async def aadd_message(self, role, content, **fields):
+        await asyncio.to_thread(self.add_message, role, content, **fields)
+
+    async def aset_messages(self, messages: list[dict]):
+        await asyncio.to_thread(self.set_messages, messages)
+
+
+@dataclass(kw_only=True)
+class SqliteSession(Session):
+    """
+    Session persisted to a SQLite database shared by all sessions.
+
+    Each message is its own row, so add_message is a single INSERT, and
+    list_sessions/load are index lookups regardless of how many sessions exist.
+    All sessions of a database share one connection, set up once; a lock
+    serializes its use across threads.
+    """
+    db_path: str
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    created_at: datetime = field(default_factory=lambda: datetime.now())
+    _messages: list[dict] = field(default_factory=list)
+
+    # Database path -> (shared connection, lock guarding it)
+    _connections: ClassVar[dict[str, tuple[sqlite3.Connection, threading.Lock]]] = {}
+    _connections_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __post_init__(self):
+        conn, lock = self._connection(self.db_path)
+        with lock, conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO sessions (id, created_at) VALUES (?, ?)",
+                (self.id, self.created_at.isoformat())
+            )
+            if cursor.rowcount and self._messages:
+                self._insert_messages(conn, self._messages)
+
+    @staticmethod
+    def connect(db_path: str) -> sqlite3.Connection:
+        """Open a new connection and create the schema if needed."""
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, created_at TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions (created_at, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages (session_id, seq)")
+        return conn
+
+    @classmethod
+    def _connection(cls, db_path: str) -> tuple[sqlite3.Connection, threading.Lock]:
+        """The database's shared connection, opened on first use."""
+        key = str(Path(db_path).resolve())
+        with cls._connections_lock:
+            if key not in cls._connections:
+                cls._connections[key] = (cls.connect(db_path), threading.Lock())
+            return cls._connections[key]
+
+    @classmethod
+    def close_database(cls, db_path: str):
+        """Close the connection shared by the database's sessions; later use reopens it."""
+        with cls._connections_lock:
+            entry = cls._connections.pop(str(Path(db_path).resolve()), None)
+        if entry is not None:
+            conn, lock = entry
+            with lock:
+                conn.close()
+
+    def _insert_messages(self, conn: sqlite3.Connection, messages: list[dict]):
+        conn.executemany(
+            "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+            [(self.id, json.dumps(message)) for message in messages]
+        )
+
+    @classmethod
+    def load(cls, session_id: str, db_path: str) -> "SqliteSession":
+        conn, lock = cls._connection(db_path)
+        with lock:
+            row = conn.execute("SELECT created_at FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                raise KeyError(f"Session {session_id} does not exist in {db_path}.")
+            created_at = datetime.fromisoformat(row[0])
+            messages = [
+                json.loads(message) for (message,) in conn.execute(
+                    "SELECT message FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+                )
+            ]
+
+        return cls(db_path=db_path, id=session_id, created_at=created_at, _messages=messages)
+
+    @classmethod
+    def list_sessions(cls, db_path: str, limit: int | None = None, offset: int = 0) -> list:
+        """List session ids, oldest first, optionally one page at a time."""
+        conn, lock = cls._connection(db_path)
+        with lock:
+            rows = conn.execute(
+                "SELECT id FROM sessions ORDER BY created_at, id LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset)
+            ).fetchall()
+
+        return [session_id for (session_id,) in rows]
+
+    def add_message(self, role, content, **fields):
+        super().add_message(role, content, **fields)
+        conn, lock = self._connection(self.db_path)
+        with lock, conn:
+            self._insert_messages(conn, self._messages[-1:])
+
+    def set_messages(self, messages: list[dict]):
+        super().set_messages(messages)
+        conn, lock = self._connection(self.db_path)
+        with lock, conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (self.id,))
+            self._insert_messages(conn, self._messages)
+
+    async def aadd_message(self, role, content, **fields):
+        await asyncio.to_thread(self.add_message, role, content, **fields)
+
+    async def aset_messages(self, messages: list[dict]):
+        await asyncio.to_thread(self.set_messages, messages)
+
+    def close(self):
+        """Close the database connection shared with the other sessions (see close_database)."""
+        self.close_database(self.db_path)
+
+
+@dataclass
+class AgentEvent:
+    """One timed phase of an agent run, passed to every hook registered on the Agent."""
+    name: str  # run, step, llm_call, parse, tools, tool_call, compaction, persist
+    run_id: str | None
+    step: int | None
+    start: float  # time.monotonic()
+    end: float
+    attributes: dict = field(default_factory=dict)
+    # Events nest like trace spans: a tool_call's parent is the tools (or llm_call) span of its step
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class LatencyCollector:
+    """
+    Default hook: collects event durations and token usage per run, and
+    dumps them as latency histograms. Thread-safe, since tool_call events
+    are emitted from the tool pool.
+    """
+    bucket_bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self._durations: dict[str, dict[str, list[float]]] = defaultdict(lambda: defaultdict(list))
+        self._tokens: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def __call__(self, event: AgentEvent):
+        with self._lock:
+            self._durations[event.run_id][event.name].append(event.duration * 1000)
+            for key in ("prompt_tokens", "completion_tokens"):
+                if key in event.attributes:
+                    self._tokens[event.run_id][key] += event.attributes[key]
+
+    def histogram(self, durations_ms: list[float]) -> dict[str, int]:
+        buckets = {f"<={bound}ms": 0 for bound in self.bucket_bounds_ms}
+        buckets["inf"] = 0
+        for duration_ms in durations_ms:
+            bound = next((bound for bound in self.bucket_bounds_ms if duration_ms <= bound), None)
+            buckets[f"<={bound}ms" if bound else "inf"] += 1
+        return buckets
+
+    def summary(self) -> dict:
+        with self._lock:
+            durations = {run_id: dict(events) for run_id, events in self._durations.items()}
+            tokens = {run_id: dict(run_tokens) for run_id, run_tokens in self._tokens.items()}
+
+        runs = {}
+        for run_id, events in durations.items():
+            run_summary = {}
+            for name, durations_ms in events.items():
+                ordered = sorted(durations_ms)
+                run_summary[name] = {
+                    "count": len(ordered),
+                    "total_ms": sum(ordered),
+                    "p50_ms": ordered[len(ordered) // 2],
+                    "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max_ms": ordered[-1],
+                    "histogram": self.histogram(ordered),
+                }
+            runs[str(run_id)] = {"events": run_summary, "tokens": tokens.get(run_id, {})}
+        return runs
+
+    def dump(self, path: str | None = None) -> str:
+        summary_json = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "w") as f:
+                f.write(summary_json)
+        return summary_json
+
+
+class TraceExporter:
+    """
+    Hook that turns AgentEvents into OpenTelemetry spans, one trace per run.
+
+    When a run ends, its spans are appended to `path` as one OTLP/JSON
+    ExportTraceServiceRequest per line (the OpenTelemetry collector file
+    exporter format), ready for Jaeger, Perfetto or any OTLP viewer.
+    Spans that finish after their run (background compaction) are written
+    by the next export or by flush().
+    """
+    def __init__(self, path: str | Path, service_name: str = "agent"):
+        self.path = Path(path)
+        self.service_name = service_name
+        # AgentEvent times are monotonic, OTLP wants wall-clock nanoseconds
+        self._epoch_offset_ns = time.time_ns() - time.monotonic_ns()
+        self._pending: list[AgentEvent] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event: AgentEvent):
+        with self._lock:
+            self._pending.append(event)
+        if event.name == "run" and event.parent_id is None:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            events, self._pending = self._pending, []
+        if not events:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self.to_otlp(events)) + "\n")
+
+    def to_otlp(self, events: list[AgentEvent]) -> dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": self._otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{
+                    "scope": {"name": "agent"},
+                    "spans": [self._otlp_span(event) for event in events],
+                }],
+            }]
+        }
+
+    def _otlp_span(self, event: AgentEvent) -> dict:
+        attributes = {"agent.step": event.step, **event.attributes}
+        span = {
+            # Run ids are uuid4 strings: their 32 hex digits are a valid trace id
+            "traceId": uuid.UUID(event.run_id).hex if event.run_id else "0" * 32,
+            "spanId": event.span_id,
+            "name": event.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(int(event.start * 1e9) + self._epoch_offset_ns),
+            "endTimeUnixNano": str(int(event.end * 1e9) + self._epoch_offset_ns),
+            "attributes": self._otlp_attributes(attributes),
+        }
+        if event.parent_id:
+            span["parentSpanId"] = event.parent_id
+        return span
+
+    @staticmethod
+    def _otlp_attributes(attributes: dict) -> list[dict]:
+        otlp_attributes = []
+        for key, value in attributes.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                otlp_value = {"boolValue": value}
+            elif isinstance(value, int):
+                otlp_value = {"intValue": str(value)}
+            elif isinstance(value, float):
+                otlp_value = {"doubleValue": value}
+            else:
+                otlp_value = {"stringValue": str(value)}
+            otlp_attributes.append({"key": key, "value": otlp_value})
+        return otlp_attributes
@@ -0,0 +1,423 @@
+"""
+Agent Loop Benchmark — Measuring the Loop, Not the Model
+
+The problem: an agent step is dominated by the LLM call, so the cost of the
+loop itself (prompt building, parsing, tool dispatch, persistence) is
+invisible when running against the real API.
+
+This replaces the OpenAI client with a deterministic in-process mock that
+replays scripted LLMOutput responses with a configurable latency, then drives
+`Agent.run` from chapters 05–08 and reports:
+- per-step overhead: wall time minus the simulated LLM latency
+- throughput: completed runs per second
+- peak memory allocated per run
+
+With --prompt-encoding it also reports the prompt tokens of chapter 08's
+system prompt and tool results under each PromptEncoder style.
+
+Runs fully offline:
+
+    python benchmark.py --runs 100 --latency 0.01
+    python benchmark.py --chapters 08 --session sqlite --stream --concurrency 50
+    python benchmark.py --chapters 08 --prompt-encoding
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice, ChoiceDelta, ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall
+
+
+IMPLEMENTATIONS_DIR = Path(__file__).resolve().parent.parent
+CHAPTERS = {
+    "05": "05_agent_class",
+    "06": "06_session_management",
+    "07": "07_agent_skills",
+    "08": "08_session_persistence",
+}
+USER_QUERY = "How is the weather in Beijing and LA?"
+
+
+# --- Mock LLM ---
+
+
+def build_script(num_tool_calls: int) -> list[list[dict]]:
+    """One run: a step with `num_tool_calls` parallel tool calls, then a final answer."""
+    locations = itertools.cycle(["beijing", "los angeles"])
+    tool_step = [{"type": "message", "text": "Let me check the weather."}] + [
+        {
+            "type": "tool_call",
+            "id": f"call_{i}",
+            "name": "get_weather",
+            "parameters": json.dumps({"location": next(locations)}),
+        }
+        for i in range(num_tool_calls)
+    ]
+    final_step = [{"type": "message", "text": "Beijing is cloudy, Los Angeles is sunny."}]
+    return [tool_step, final_step]
+
+
+# User-role messages the agent adds itself (tool results, error feedback, compaction
+# summaries, late tool results); any other user message starts a new query
+AGENT_USER_MESSAGE_PREFIXES = (
+    "Tool call results", "Invalid response format", "[COMPACT SESSION HISTORY]", "Late tool call results",
+)
+
+
+class MockCompletions:
+    """
+    Stand-in for `client.chat.completions` that replays a script.
+
+    The reply is picked from the conversation itself (the number of assistant
+    turns since the last user query), so any number of sessions can share one
+    mock and every run replays the same script deterministically.
+    """
+    def __init__(self, script: list[list[dict]], latency: float = 0.0, chunk_size: int = 16):
+        self.script = script
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.simulated_seconds = 0.0
+        self._ids = itertools.count()
+
+    def _next_items(self, messages: list[dict]) -> list[dict] | None:
+        if not any(message["role"] in ("developer", "system") for message in messages):
+            # Compaction and other one-off prompts get a plain text reply
+            return None
+        step = 0
+        for message in reversed(messages):
+            if message["role"] == "assistant":
+                step += 1
+            elif message["role"] == "user" and not str(message["content"]).startswith(AGENT_USER_MESSAGE_PREFIXES):
+                break
+        return self.script[min(step, len(self.script) - 1)]
+
+    def _usage(self, messages: list[dict], completion: str) -> CompletionUsage:
+        prompt_tokens = len(json.dumps(messages)) // 4
+        completion_tokens = len(completion) // 4
+        return CompletionUsage(
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+    def _reply(self, messages: list[dict], native_tools: bool) -> tuple[str | None, list[dict]]:
+        """(content, native tool calls) for the next scripted step."""
+        self.calls += 1
+        self.simulated_seconds += self.latency
+        items = self._next_items(messages)
+        if items is None:
+            return "Compacted session summary.", []
+        if not native_tools:
+            return json.dumps({"content": items}), []
+
+        text = "\n".join(item["text"] for item in items if item["type"] == "message")
+        tool_calls = [
+            dict(id=item["id"], type="function", function=dict(name=item["name"], arguments=item["parameters"]))
+            for item in items if item["type"] == "tool_call"
+        ]
+        return text, tool_calls
+
+    def _completion(self, model, messages, content, tool_calls) -> ChatCompletion:
+        message = ChatCompletionMessage(
+            role="assistant", content=content,
+            tool_calls=[ChatCompletionMessageToolCall(**tool_call) for tool_call in tool_calls] or None
+        )
+        return ChatCompletion(
+            id=f"mock-{next(self._ids)}", object="chat.completion", created=int(time.time()), model=model,
+            choices=[Choice(index=0, finish_reason="tool_calls" if tool_calls else "stop", message=message)],
+            usage=self._usage(messages, content or json.dumps(tool_calls)),
+        )
+
+    def _chunks(self, model, messages, content, tool_calls) -> list[ChatCompletionChunk]:
+        chunk_id, created = f"mock-{next(self._ids)}", int(time.time())
+
+        def chunk(delta: ChoiceDelta | None = None, usage: CompletionUsage | None = None) -> ChatCompletionChunk:
+            choices = [ChunkChoice(index=0, delta=delta)] if delta else []
+            return ChatCompletionChunk(
+                id=chunk_id, object="chat.completion.chunk", created=created, model=model,
+                choices=choices, usage=usage
+            )
+
+        content = content or ""
+        chunks = [
+            chunk(ChoiceDelta(content=content[i:i + self.chunk_size]))
+            for i in range(0, len(content), self.chunk_size)
+        ]
+        chunks += [
+            chunk(ChoiceDelta(tool_calls=[ChoiceDeltaToolCall(index=index, **tool_call)]))
+            for index, tool_call in enumerate(tool_calls)
+        ]
+        chunks.append(chunk(usage=self._usage(messages, content or json.dumps(tool_calls))))
+        return chunks
+
+    def create(self, model: str, messages: list[dict], stream: bool = False, tools: list | None = None, **kwargs):
+        content, tool_calls = self._reply(messages, native_tools=bool(tools))
+        time.sleep(self.latency)
+        if stream:
+            return iter(self._chunks(model, messages, content, tool_calls))
+        return self._completion(model, messages, content, tool_calls)
+
+
+class AsyncMockCompletions(MockCompletions):
+    async def create(self, model: str, messages: list[dict], stream: bool = False, tools: list | None = None, **kwargs):
+        content, tool_calls = self._reply(messages, native_tools=bool(tools))
+        await asyncio.sleep(self.latency)
+        if not stream:
+            return self._completion(model, messages, content, tool_calls)
+
+        async def chunk_stream():
+            for chunk in self._chunks(model, messages, content, tool_calls):
+                yield chunk
+        return chunk_stream()
+
+
+def mock_client(completions: MockCompletions) -> SimpleNamespace:
+    """An object shaped like OpenAI()/AsyncOpenAI() as far as the agents use it."""
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+# --- Loading chapters ---
+
+
+def load_chapter(chapter: str):
+    """
+    Import a chapter's main.py as its own module, returning it together with
+    the chapter's agent_utils module (None for chapters without one).
+    """
+    chapter_dir = IMPLEMENTATIONS_DIR / CHAPTERS[chapter]
+    # The agents construct OpenAI() eagerly; a placeholder key keeps this offline
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark-placeholder")
+    sys.modules.pop("agent_utils", None)
+    sys.path.insert(0, str(chapter_dir))
+    try:
+        spec = importlib.util.spec_from_file_location(f"chapter_{chapter}_main", chapter_dir / "main.py")
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(chapter_dir))
+    # Each chapter has its own agent_utils: don't let the next chapter pick this one up
+    return module, sys.modules.pop("agent_utils", None)
+
+
+def make_session(module, agent_utils, session_kind: str, session_dir: str):
+    if session_kind == "none" or not hasattr(module, "Session"):
+        return None
+    if session_kind == "memory":
+        return module.Session()
+
+    if session_kind == "json":
+        return agent_utils.FileSession(session_dir=session_dir)
+    elif session_kind == "jsonl":
+        return agent_utils.FileSession(session_dir=session_dir, storage="jsonl")
+    else:
+        return agent_utils.SqliteSession(db_path=str(Path(session_dir, "sessions.db")))
+
+
+# --- Benchmark ---
+
+
+@dataclass
+class BenchmarkResult:
+    chapter: str
+    runs: int
+    steps: int
+    wall_seconds: float
+    simulated_seconds: float
+    peak_memory_bytes: int
+
+    @property
+    def overhead_per_step_ms(self) -> float:
+        return (self.wall_seconds - self.simulated_seconds) / max(self.steps, 1) * 1000
+
+    @property
+    def runs_per_second(self) -> float:
+        return self.runs / self.wall_seconds if self.wall_seconds else float("inf")
+
+
+def build_agent(module, chapter: str, args, completions: MockCompletions):
+    tools = [{"function": module.get_weather, "parameters": module.GetWeatherParameters}]
+    agent_kwargs = {}
+    if chapter == "08":
+        agent_kwargs = dict(stream=args.stream, tool_mode=args.tool_mode)
+    agent = module.Agent(tools, **agent_kwargs)
+    agent._client = mock_client(completions)
+    if hasattr(agent, "_async_client"):
+        agent._async_client = mock_client(AsyncMockCompletions(completions.script, completions.latency))
+    return agent
+
+
+def run_once(agent, module, agent_utils, args, session_dir: str):
+    session = make_session(module, agent_utils, args.session, session_dir)
+    if session is None:
+        return agent.run(USER_QUERY)
+    return agent.run(USER_QUERY, session=session)
+
+
+def benchmark_chapter(chapter: str, args) -> BenchmarkResult:
+    module, agent_utils = load_chapter(chapter)
+    script = build_script(args.tool_calls)
+    completions = MockCompletions(script, latency=args.latency)
+    agent = build_agent(module, chapter, args, completions)
+
+    with tempfile.TemporaryDirectory() as session_dir, contextlib.redirect_stdout(io.StringIO()) as output:
+        for _ in range(args.warmup):
+            run_once(agent, module, agent_utils, args, session_dir)
+            output.seek(0)
+            output.truncate()
+
+        completions.calls, completions.simulated_seconds = 0, 0.0
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            run_once(agent, module, agent_utils, args, session_dir)
+            # Agent prints are part of the loop cost, but don't keep them around
+            output.seek(0)
+            output.truncate()
+        wall_seconds = time.perf_counter() - start
+        steps, simulated_seconds = completions.calls, completions.simulated_seconds
+
+        # Memory in a separate pass: tracemalloc slows everything down
+        tracemalloc.start()
+        for _ in range(min(args.runs, 10)):
+            run_once(agent, module, agent_utils, args, session_dir)
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    if hasattr(agent, "close"):
+        agent.close()
+    return BenchmarkResult(chapter, args.runs, steps, wall_seconds, simulated_seconds, peak_memory_bytes)
+
+
+def benchmark_concurrent(args) -> BenchmarkResult:
+    """Chapter 08 only: `concurrency` sessions multiplexed on one event loop with arun()."""
+    module, agent_utils = load_chapter("08")
+    completions = AsyncMockCompletions(build_script(args.tool_calls), latency=args.latency)
+    agent = build_agent(module, "08", args, completions)
+    agent._async_client = mock_client(completions)
+
+    async def run_all(session_dir: str):
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def run_one():
+            async with semaphore:
+                session = make_session(module, agent_utils, args.session, session_dir) or module.Session()
+                await agent.arun(USER_QUERY, session=session)
+        await asyncio.gather(*(run_one() for _ in range(args.runs)))
+
+    with tempfile.TemporaryDirectory() as session_dir, contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        start = time.perf_counter()
+        asyncio.run(run_all(session_dir))
+        wall_seconds = time.perf_counter() - start
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    agent.close()
+    # With concurrency the simulated latency overlaps, so only one "lane" of it is subtracted
+    lanes = min(args.concurrency, args.runs)
+    return BenchmarkResult(
+        f"08 x{args.concurrency}", args.runs, completions.calls, wall_seconds,
+        completions.simulated_seconds / lanes, peak_memory_bytes
+    )
+
+
+def benchmark_prompt_encoding(args):
+    """Chapter 08 only: prompt tokens per step under each PromptEncoder style, on the example tools."""
+    module, agent_utils = load_chapter("08")
+    tools = [
+        {"function": module.get_weather, "parameters": module.GetWeatherParameters},
+        {"function": module.send_email, "parameters": module.SendEmailParameters},
+        {"function": module.get_user_profile, "parameters": module.GetUserProfileParameters},
+    ]
+    locations = itertools.islice(itertools.cycle(["Beijing", "Los Angeles"]), args.tool_calls)
+    tool_call_results = [
+        {"id": f"call_{index}", "result": module.get_weather(location)} for index, location in enumerate(locations)
+    ]
+    tool_call_results.append({"id": "call_profile", "result": str(module.get_user_profile())})
+
+    counter = agent_utils.TokenCounter()
+    baseline = None
+    header = f"{'encoding':<10}{'system prompt':>15}{'tool results':>14}{'per step':>10}{'saved':>8}"
+    print(header)
+    print("-" * len(header))
+    for style in ("pretty", "minified", "lines"):
+        agent = module.Agent(tools, prompt_encoder=agent_utils.PromptEncoder(style))
+        system_tokens = counter.count_text(agent.system_prompt)
+        result_tokens = counter.count_text(agent._format_tool_results(tool_call_results))
+        agent.close()
+        # The system prompt is resent every step; each result message stays in every later prompt
+        per_step = system_tokens + result_tokens
+        baseline = baseline or per_step
+        print(
+            f"{style:<10}{system_tokens:>15}{result_tokens:>14}{per_step:>10}"
+            f"{(baseline - per_step) / baseline:>8.1%}"
+        )
+    if agent_utils.tiktoken is None:
+        print("(tiktoken not installed: token counts are estimated at ~4 characters per token)")
+
+
+def print_results(results: list[BenchmarkResult]):
+    header = f"{'chapter':<10}{'runs':>6}{'steps':>7}{'wall (s)':>10}{'llm (s)':>9}{'overhead/step (ms)':>20}{'runs/s':>9}{'peak mem (KiB)':>16}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result.chapter:<10}{result.runs:>6}{result.steps:>7}{result.wall_seconds:>10.3f}"
+            f"{result.simulated_seconds:>9.3f}{result.overhead_per_step_ms:>20.3f}"
+            f"{result.runs_per_second:>9.1f}{result.peak_memory_bytes / 1024:>16.1f}"
+        )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the agent loop against a deterministic mock LLM.")
+    parser.add_argument("--chapters", nargs="+", choices=sorted(CHAPTERS), default=sorted(CHAPTERS))
+    parser.add_argument("--runs", type=int, default=50, help="agent runs per chapter")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed runs before measuring")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--tool-calls", type=int, default=2, help="parallel tool calls in the scripted step")
+    parser.add_argument(
+        "--session", choices=["none", "memory", "json", "jsonl", "sqlite"], default="memory",
+        help="session backend (json/jsonl/sqlite only apply to chapter 08)"
+    )
+    parser.add_argument("--stream", action="store_true", help="chapter 08: streaming mode")
+    parser.add_argument("--tool-mode", choices=["prompt", "native"], default="prompt", help="chapter 08: tool calling mode")
+    parser.add_argument("--concurrency", type=int, default=0, help="chapter 08: also run this many sessions concurrently with arun()")
+    parser.add_argument(
+        "--prompt-encoding", action="store_true", help="chapter 08: also report prompt tokens per PromptEncoder style"
+    )
+    args = parser.parse_args(argv)
+
+    if args.session in ("json", "jsonl", "sqlite") and args.chapters != ["08"]:
+        parser.error("--session json/jsonl/sqlite requires --chapters 08")
+    return args
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    results = [benchmark_chapter(chapter, args) for chapter in args.chapters]
+    if args.concurrency:
+        results.append(benchmark_concurrent(args))
+    print_results(results)
+    if args.prompt_encoding:
+        print()
+        benchmark_prompt_encoding(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,140 +10,1075 @@ This builds on Session Management with key additions:
 3. Resume conversations across process restarts
 """
 
+import asyncio
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from agent_utils import FileSession, LLMOutput, Message, Session, Tool, ToolCall, ToolRegistry
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Literal
+from agent_utils import (
+    AgentEvent, BM25ToolIndex, CompletionCache, CompletionStreamAccumulator, FileSession, LatencyCollector, LLMOutput,
+    Message, PromptEncoder, ResultStore, SearchToolsParameters, Session, TokenCounter, Tool, ToolBulkhead, ToolCache,
+    ToolCall, ToolError, ToolExecutor, ToolIndex, ToolRegistry, TraceExporter, native_to_tool_call
+)
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.types import CompletionUsage
 from pydantic import BaseModel, Field
 
 
 # --- Agent Class ---
 
+# Marks the message holding the compacted session history
+COMPACT_SUMMARY_PREFIX = "[COMPACT SESSION HISTORY]: "
+
+# The run and step being executed, attached to every AgentEvent. Context variables
+# keep concurrent arun() calls apart, each asyncio task has its own copy.
+_current_run_id: ContextVar[str | None] = ContextVar("current_run_id", default=None)
+_current_step: ContextVar[int | None] = ContextVar("current_step", default=None)
+# The session being run, which per-session tool concurrency limits count by
+_current_session_id: ContextVar[str | None] = ContextVar("current_session_id", default=None)
+# The innermost timed phase, which becomes the parent span of the next AgentEvent
+_current_span_id: ContextVar[str | None] = ContextVar("current_span_id", default=None)
+# The tools offered to the model in this run, in prompt order (None: all of them).
+# Picked once per run and only grown, so the system prompt stays the same between steps.
+_current_tools: ContextVar[list[str] | None] = ContextVar("current_tools", default=None)
+
+
+@dataclass
+class PendingCompaction:
+    """A compaction running in the background, swapped into the session once it finishes."""
+    future: Future | asyncio.Task
+    kept_messages: list[dict]
+    # Messages added after the snapshot are appended after the summary on swap
+    snapshot_len: int
+
+
+@dataclass
+class ToolCallSchedule:
+    """Progress of one step's tool calls through their dependency graph."""
+    start: float
+    ids: set[str]
+    waiting: list[ToolCall]
+    running: dict[Future, ToolCall]
+    submitted_at: dict[Future, float]
+    deadlines: dict[Future, float | None]
+    # Results by tool call id, in completion order
+    finished: dict[str, dict] = field(default_factory=dict)
+    # Ids whose results were already handed to the model
+    delivered: set[str] = field(default_factory=set)
+
 
 class Agent:
     def __init__(
             self, tools: list | None = None, model: str="gpt-5.2", max_steps: int=10,
-            max_prompt_tokens: int=100_000
+            max_prompt_tokens: int=100_000, stream: bool=False,
+            tool_executor: ToolExecutor | None = None, max_tool_workers: int | None = None,
+            max_tool_processes: int | None = None, tool_cache: ToolCache | None = None,
+            completion_cache: CompletionCache | None = None,
+            tool_mode: Literal["prompt", "native"] = "prompt", token_counter: TokenCounter | None = None,
+            compaction: Literal["full", "rolling"] = "full", compaction_keep_messages: int = 6,
+            background_compaction: bool = False, max_context_tokens: int | None = None,
+            hooks: list[Callable[[AgentEvent], None]] | None = None, tool_timeout: float | None = None,
+            tool_result_deadline: float | None = None, result_store: ResultStore | None = None,
+            prompt_encoder: PromptEncoder | None = None, tool_index: ToolIndex | None = None,
+            max_tools_in_prompt: int | None = None, tool_bulkheads: dict[str, ToolBulkhead] | None = None
         ):
-        self._tool_registry = ToolRegistry()
+        # With `max_tools_in_prompt` each step only carries the tools most relevant to the
+        # query (BM25 over the registry unless a ToolIndex is given) plus a search_tools
+        # meta-tool to find the rest, so the prompt stays bounded however many tools there are
+        self.max_tools_in_prompt = max_tools_in_prompt
+        if max_tools_in_prompt is not None:
+            tool_index = tool_index or BM25ToolIndex()
+        # Tools opt in to caching with `cache=True`; pass the same ToolCache to share it between agents.
+        # Tool concurrency limits hold per agent; pass the same `tool_bulkheads` dict (e.g. along
+        # with a shared ToolExecutor) to enforce them across agents
+        self._tool_registry = ToolRegistry(cache=tool_cache, index=tool_index, bulkheads=tool_bulkheads)
         tools = tools or []
         for tool_dict in tools:
             tool_obj = Tool.from_function(**tool_dict)
             self._tool_registry.register(tool_obj)
+        # Tools sent with every step when tools are selected
+        self._pinned_tools: list[str] = []
+        # Large results are kept on disk; the session holds a preview and a handle for read_tool_result
+        self.result_store = result_store
+        if result_store is not None:
+            self._tool_registry.register(result_store.as_tool(), indexed=False)
+            self._pinned_tools.append("read_tool_result")
+        if max_tools_in_prompt is not None:
+            self._tool_registry.register(Tool(
+                name="search_tools",
+                description=(
+                    "Search all available tools by what they do. Returns the matching tools' schemas; "
+                    "they can be called from the next step on."
+                ),
+                parameters=SearchToolsParameters,
+                function=self._search_tools,
+                backend="inline",
+            ), indexed=False)
+            self._pinned_tools.append("search_tools")
+        # Tools each session called or found with search_tools, most recent last; up to
+        # `max_tools_in_prompt` of them are offered again in the session's next runs.
+        # Kept for the most recently active sessions only.
+        self._session_tools: OrderedDict[str | None, OrderedDict[str, None]] = OrderedDict()
+        self._system_prompts: OrderedDict[tuple[str, ...], str] = OrderedDict()
 
         self.model = model
         self.max_steps = max_steps
         self.max_prompt_tokens = max_prompt_tokens
+        # Stream the LLM output and start each tool call as soon as it is complete
+        self.stream = stream
+        # "prompt": tool schemas and LLMOutput schema in the system prompt, JSON replies
+        # "native": tool schemas via the API `tools` parameter, tool calls via `tool_calls`
+        self.tool_mode = tool_mode
+        # Step-wide limit on waiting for tool results; tools can set a tighter `timeout` of their own
+        self.tool_timeout = tool_timeout
+        # Stop waiting for a step's tools after this many seconds: finished results go to the
+        # model right away, stragglers keep running and are delivered in a later turn by id
+        self.tool_result_deadline = tool_result_deadline
+        self._late_tool_calls: dict[str | None, list[ToolCallSchedule]] = {}
+        # Pass a ToolExecutor to share one pool between agents; otherwise the agent owns its own
+        self._owns_tool_executor = tool_executor is None
+        self._tool_executor = tool_executor or ToolExecutor(
+            max_workers=max_tool_workers, max_processes=max_tool_processes
+        )
+        # Replays identical requests (same model and messages) without calling the API
+        self.completion_cache = completion_cache
+        # With a token counter the prompt size is checked locally before each call
+        self.token_counter = token_counter
+        # "full": summarize the whole history into one message
+        # "rolling": keep a running summary plus the last `compaction_keep_messages` messages,
+        #            summarizing only what aged out since the last compaction
+        self.compaction = compaction
+        self.compaction_keep_messages = compaction_keep_messages
+        # Summarize off the critical path: the next steps use the raw history until the
+        # summary is ready, unless that would exceed the model's hard context limit
+        self.background_compaction = background_compaction
+        self.max_context_tokens = max_context_tokens or 2 * max_prompt_tokens
+        # Only needed by the background compaction guard, created on first use
+        self._context_counter: TokenCounter | None = token_counter
+        self._pending_compactions: dict[str, PendingCompaction] = {}
+        self._compaction_executor: ThreadPoolExecutor | None = None
+        # Called with an AgentEvent for every timed phase (e.g. a LatencyCollector).
+        # tool_call events arrive from pool threads, so hooks must be thread-safe.
+        self.hooks = list(hooks or [])
+        # How tool schemas, the output schema and tool results are written into prompts
+        self.prompt_encoder = prompt_encoder or PromptEncoder()
         self._client = OpenAI()
+        self._async_client = AsyncOpenAI()
         self.system_prompt = self._build_system_prompt()
 
-    def _build_system_prompt(self) -> str:
-        tools_doc = json.dumps(
-            self._tool_registry.to_schemas(), indent=2
+    def close(self):
+        if self._owns_tool_executor:
+            self._tool_executor.shutdown()
+        if self._compaction_executor is not None:
+            self._compaction_executor.shutdown()
+
+    def __enter__(self) -> "Agent":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def bulkhead_stats(self) -> dict[str, dict]:
+        """Per-tool in-flight calls, queue length and queue wait for tools with a concurrency limit."""
+        return self._tool_registry.bulkhead_stats()
+
+    def _emit(self, event: AgentEvent):
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                print(f"Warning: hook {hook} failed: {e}")
+
+    @contextmanager
+    def _timed(self, name: str, **attributes):
+        """Emit an AgentEvent covering the block; the yielded attributes can be filled in by it."""
+        if not self.hooks:
+            yield attributes
+            return
+        event = AgentEvent(
+            name, _current_run_id.get(), _current_step.get(), time.monotonic(), 0.0, attributes,
+            parent_id=_current_span_id.get()
         )
+        span_token = _current_span_id.set(event.span_id)
+        try:
+            yield attributes
+        finally:
+            _current_span_id.reset(span_token)
+            event.end = time.monotonic()
+            self._emit(event)
+
+    def _emit_on_done(self, future: Future | asyncio.Task, event_name: str, **attributes):
+        """Emit an AgentEvent from submission until `future` completes, wherever it completes."""
+        if not self.hooks:
+            return
+        event = AgentEvent(
+            event_name, _current_run_id.get(), _current_step.get(), time.monotonic(), 0.0, attributes,
+            parent_id=_current_span_id.get()
+        )
+
+        def on_done(_):
+            event.end = time.monotonic()
+            # Thread-pool tool calls record when a worker picked them up: the gap is queueing delay
+            started_at = getattr(future, "timing", {}).get("started_at")
+            if started_at is not None:
+                self._emit(AgentEvent(
+                    "queue_wait", event.run_id, event.step, event.start, started_at, parent_id=event.span_id
+                ))
+            self._emit(event)
+
+        future.add_done_callback(on_done)
+
+    def _persist(self, session: Session, **message):
+        with self._timed("persist", role=message["role"]):
+            session.add_message(**message)
+
+    async def _apersist(self, session: Session, **message):
+        with self._timed("persist", role=message["role"]):
+            await session.aadd_message(**message)
+
+    def _search_tools(self, query: str, k: int = 5) -> str:
+        names = self._tool_registry.search(query, min(k, self.max_tools_in_prompt))
+        if not names:
+            return "No matching tools."
+        # search_tools runs inline, so this is still the calling run's context
+        self._add_tools(names)
+        return self.prompt_encoder.encode(self._tool_registry.to_schemas(names))
+
+    def _select_tools(self, user_query: str, session: Session) -> list[str] | None:
+        """
+        The tools to offer for a run, or None for all of them: the top
+        `max_tools_in_prompt` matches for the user query, the session's recently
+        used tools and the pinned meta-tools.
+        """
+        if self.max_tools_in_prompt is None:
+            return None
+        names = set(self._tool_registry.search(user_query, self.max_tools_in_prompt))
+        names.update(self._session_tools.get(session.id, ()))
+        names.difference_update(self._pinned_tools)
+        # Sorted, so the same selection gives a byte-identical prompt (completion cache hits)
+        return sorted(names) + self._pinned_tools
+
+    def _selected_tools(self) -> tuple[str, ...] | None:
+        selected = _current_tools.get()
+        return None if selected is None else tuple(selected)
+
+    def _add_tools(self, names: list[str]):
+        """Offer tools found with search_tools or called by the model from the next step on."""
+        selected = _current_tools.get()
+        if selected is None:
+            return
+        for name in names:
+            if name not in selected and self._tool_registry.get(name) is not None:
+                # Appended, so the tools already in the prompt keep their place
+                selected.append(name)
+        session_id = _current_session_id.get()
+        used = self._session_tools.setdefault(session_id, OrderedDict())
+        self._session_tools.move_to_end(session_id)
+        if len(self._session_tools) > 1024:
+            self._session_tools.popitem(last=False)
+        for name in names:
+            if name not in self._pinned_tools and self._tool_registry.get(name) is not None:
+                used[name] = None
+                used.move_to_end(name)
+        while len(used) > self.max_tools_in_prompt:
+            used.popitem(last=False)
+
+    def _system_prompt_for(self, tool_names: tuple[str, ...] | None) -> str:
+        if tool_names is None or self.tool_mode == "native":
+            return self.system_prompt
+        system_prompt = self._system_prompts.get(tool_names)
+        if system_prompt is None:
+            system_prompt = self._system_prompts[tool_names] = self._build_system_prompt(tool_names)
+            if len(self._system_prompts) > 256:
+                self._system_prompts.popitem(last=False)
+        else:
+            self._system_prompts.move_to_end(tool_names)
+        return system_prompt
+
+    def _build_system_prompt(self, tool_names: tuple[str, ...] | None = None) -> str:
+        if self.tool_mode == "native":
+            return "Use the provided tools when they help. When you are done, reply with your final answer."
+
+        schemas = self._tool_registry.to_schemas(None if tool_names is None else list(tool_names))
+        tools_doc = self.prompt_encoder.encode(schemas)
+        output_schema = self.prompt_encoder.encode(LLMOutput.model_json_schema())
 
         system_prompt = f"""You are provided the following tools to use:
 {tools_doc}
 
 Please return your response in the following format:
-{LLMOutput.model_json_schema()}
+{output_schema}
 
 RETURN ONLY THE JSON."""
 
         return system_prompt
 
-    def _build_messages(self, session: Session):
-        return [dict(role="developer", content=self.system_prompt)] + session.get_messages()
-    
-    def _compact_session(self, session: Session):
+    def _build_messages(self, session: Session, tool_names: tuple[str, ...] | None = None):
+        return [dict(role="developer", content=self._system_prompt_for(tool_names))] + session.get_messages()
+
+    def _completion_params(self, tool_names: tuple[str, ...] | None = None) -> dict:
+        """Extra parameters for agent steps (not compaction) sent with the completion request."""
+        schemas = self._tool_registry.to_schemas(None if tool_names is None else list(tool_names))
+        if self.tool_mode == "native" and schemas:
+            return dict(tools=[dict(type="function", function=schema) for schema in schemas])
+        return {}
+
+    def _plan_compaction(self, session: Session) -> tuple[list[dict], list[dict]] | None:
+        """
+        Returns (summarization prompt, messages to keep verbatim after the
+        summary), or None when there is nothing to compact.
+        """
         session_messages = session.get_messages()
-        compact_messages, _ = self._call_llm(
-            [{
+        if self.compaction == "full":
+            return [{
                 "role": "user",
                 "content": f"Session history: {session_messages}\n\nSummarize the session history into a compact one. Return the compact history only."
-            }]
-        )
-        session.set_messages(
-            [dict(role="user", content=compact_messages)]
+            }], []
+
+        # Rolling: fold only the messages that aged out of the tail into the running summary
+        summary, start = "", 0
+        if session_messages and str(session_messages[0]["content"]).startswith(COMPACT_SUMMARY_PREFIX):
+            summary, start = session_messages[0]["content"][len(COMPACT_SUMMARY_PREFIX):], 1
+        cut = len(session_messages) - self.compaction_keep_messages
+        # Never split tool results from the assistant message that requested them
+        while 0 <= cut < len(session_messages) and session_messages[cut]["role"] == "tool":
+            cut += 1
+        if cut <= start:
+            return None
+
+        aged_messages = json.dumps(session_messages[start:cut])
+        return [{
+            "role": "user",
+            "content": f"Current summary: {summary or '(empty)'}\n\nNew session history: {aged_messages}\n\n"
+                       "Update the summary with the new session history, keeping it compact. Return the updated summary only."
+        }], session_messages[cut:]
+
+    def _compact_session(self, session: Session):
+        if session.id in self._pending_compactions:
+            return
+        plan = self._plan_compaction(session)
+        if plan is None:
+            return
+        compact_prompt, kept_messages = plan
+        if self.background_compaction:
+            if self._compaction_executor is None:
+                self._compaction_executor = ThreadPoolExecutor(thread_name_prefix="compaction")
+            future = self._compaction_executor.submit(self._call_llm, compact_prompt)
+            self._emit_on_done(future, "compaction", mode=self.compaction, background=True)
+            self._pending_compactions[session.id] = PendingCompaction(
+                future, kept_messages, len(session.get_messages())
+            )
+            return
+        with self._timed("compaction", mode=self.compaction, background=False):
+            compact_message, _ = self._call_llm(compact_prompt)
+            with self._timed("persist", role="compaction"):
+                session.set_messages(
+                    [dict(role="user", content=COMPACT_SUMMARY_PREFIX + compact_message["content"])] + kept_messages
+                )
+
+    async def _acompact_session(self, session: Session):
+        if session.id in self._pending_compactions:
+            return
+        plan = self._plan_compaction(session)
+        if plan is None:
+            return
+        compact_prompt, kept_messages = plan
+        if self.background_compaction:
+            task = asyncio.create_task(self._acall_llm(compact_prompt))
+            self._emit_on_done(task, "compaction", mode=self.compaction, background=True)
+            self._pending_compactions[session.id] = PendingCompaction(
+                task, kept_messages, len(session.get_messages())
+            )
+            return
+        with self._timed("compaction", mode=self.compaction, background=False):
+            compact_message, _ = await self._acall_llm(compact_prompt)
+            with self._timed("persist", role="compaction"):
+                await session.aset_messages(
+                    [dict(role="user", content=COMPACT_SUMMARY_PREFIX + compact_message["content"])] + kept_messages
+                )
+
+    def _must_wait_for_compaction(self, session: Session, pending: PendingCompaction) -> bool:
+        # The guard: proceeding with the raw history is only allowed below the hard context limit
+        if pending.future.done():
+            return False
+        if self._context_counter is None:
+            self._context_counter = TokenCounter()
+        return self._estimate_prompt_tokens(session, self._context_counter) >= self.max_context_tokens
+
+    def _compacted_messages(self, session: Session, pending: PendingCompaction) -> list[dict] | None:
+        """The session messages with the finished summary swapped in, or None if it can't be used."""
+        if pending.future.cancelled() or pending.future.exception() is not None:
+            return None
+        session_messages = session.get_messages()
+        if len(session_messages) < pending.snapshot_len:
+            return None
+        compact_message, _ = pending.future.result()
+        return (
+            [dict(role="user", content=COMPACT_SUMMARY_PREFIX + compact_message["content"])]
+            + pending.kept_messages + session_messages[pending.snapshot_len:]
         )
 
-    def _is_over_limit(self, usage: CompletionUsage) -> bool:
+    def _swap_in_compaction(self, step: int, session: Session):
+        pending = self._pending_compactions.get(session.id)
+        if pending is None:
+            return
+        if self._must_wait_for_compaction(session, pending):
+            print(f"[Step {step + 1}] Waiting for background compaction to stay under the context limit")
+            wait([pending.future])
+        if not pending.future.done():
+            return
+
+        del self._pending_compactions[session.id]
+        compacted_messages = self._compacted_messages(session, pending)
+        if compacted_messages is not None:
+            print(f"[Step {step + 1}] Background compaction finished, swapping in the summary")
+            with self._timed("persist", role="compaction"):
+                session.set_messages(compacted_messages)
+
+    async def _aswap_in_compaction(self, step: int, session: Session):
+        pending = self._pending_compactions.get(session.id)
+        if pending is None:
+            return
+        if self._must_wait_for_compaction(session, pending):
+            print(f"[Step {step + 1}] Waiting for background compaction to stay under the context limit")
+            await asyncio.wait([pending.future])
+        if not pending.future.done():
+            return
+
+        del self._pending_compactions[session.id]
+        compacted_messages = self._compacted_messages(session, pending)
+        if compacted_messages is not None:
+            print(f"[Step {step + 1}] Background compaction finished, swapping in the summary")
+            with self._timed("persist", role="compaction"):
+                await session.aset_messages(compacted_messages)
+
+    def _is_over_limit(self, session: Session, usage: CompletionUsage | None) -> bool:
+        if usage is None:
+            # A stream can end without a usage chunk (interrupted, or a server that ignores
+            # stream_options): fall back to the local estimate, if there is one
+            return self._is_estimated_over_limit(session)
         return usage.prompt_tokens >= self.max_prompt_tokens
 
-    def _call_llm(self, messages: list[dict]) -> tuple[str, CompletionUsage]:
-        response = self._client.chat.completions.create(model=self.model, messages=messages)
-        return str(response.choices[0].message.content), response.usage
+    def _estimate_prompt_tokens(self, session: Session, counter: TokenCounter | None = None) -> int:
+        counter = counter or self.token_counter
+        tool_names = self._selected_tools()
+        system_message = dict(role="developer", content=self._system_prompt_for(tool_names))
+        params_tokens = counter.count_text(json.dumps(self._completion_params(tool_names)))
+        return counter.count_message(system_message) + params_tokens + session.count_tokens(counter)
 
-    def _execute_tools_parallel(self, tool_calls: list[ToolCall]) -> str:
-        tool_call_results = []
-        with ThreadPoolExecutor() as executor:
-            futures = {
-                executor.submit(
-                    self._tool_registry.execute,
-                    tool_call.name,
-                    tool_call.parameters
-                ): tool_call
-                for tool_call in tool_calls
-            }
-            for future in as_completed(futures):
-                function_call = futures[future]
-                result = future.result()
-                tool_call_results.append(
-                    {"id": function_call.id, "result": result}
+    def _is_estimated_over_limit(self, session: Session) -> bool:
+        if self.token_counter is None:
+            return False
+        return self._estimate_prompt_tokens(session) >= self.max_prompt_tokens
+
+    def _get_cached_completion(self, messages: list[dict], params: dict) -> tuple[dict, CompletionUsage] | None:
+        if self.completion_cache is None:
+            return None
+        entry = self.completion_cache.get(CompletionCache.make_key(self.model, messages, **params))
+        return self._cached_completion(entry)
+
+    async def _aget_cached_completion(self, messages: list[dict], params: dict) -> tuple[dict, CompletionUsage] | None:
+        if self.completion_cache is None:
+            return None
+        entry = await self.completion_cache.aget(CompletionCache.make_key(self.model, messages, **params))
+        return self._cached_completion(entry)
+
+    @staticmethod
+    def _cached_completion(entry: dict | None) -> tuple[dict, CompletionUsage] | None:
+        if entry is None:
+            return None
+        usage = CompletionUsage.model_validate(entry["usage"]) if entry["usage"] else None
+        return entry["message"], usage
+
+    def _cache_completion(self, messages: list[dict], params: dict, message: dict, usage: CompletionUsage | None):
+        if self.completion_cache is not None:
+            self.completion_cache.put(
+                CompletionCache.make_key(self.model, messages, **params), message, usage.model_dump() if usage else None
+            )
+
+    async def _acache_completion(self, messages: list[dict], params: dict, message: dict, usage: CompletionUsage | None):
+        if self.completion_cache is not None:
+            await self.completion_cache.aput(
+                CompletionCache.make_key(self.model, messages, **params), message, usage.model_dump() if usage else None
+            )
+
+    @staticmethod
+    def _to_assistant_message(response) -> dict:
+        response_message = response.choices[0].message
+        message = dict(role="assistant", content=str(response_message.content or ""))
+        if response_message.tool_calls:
+            message["tool_calls"] = [
+                dict(
+                    id=tool_call.id, type="function",
+                    function=dict(name=tool_call.function.name, arguments=tool_call.function.arguments)
+                )
+                for tool_call in response_message.tool_calls
+            ]
+        return message
+
+    def _call_llm(self, messages: list[dict], **params) -> tuple[dict, CompletionUsage]:
+        """Call the LLM and return the assistant message (content, plus tool_calls in native mode)."""
+        cached = self._get_cached_completion(messages, params)
+        if cached:
+            return cached
+        response = self._client.chat.completions.create(model=self.model, messages=messages, **params)
+        message = self._to_assistant_message(response)
+        self._cache_completion(messages, params, message, response.usage)
+        return message, response.usage
+
+    async def _acall_llm(self, messages: list[dict], **params) -> tuple[dict, CompletionUsage]:
+        cached = await self._aget_cached_completion(messages, params)
+        if cached:
+            return cached
+        response = await self._async_client.chat.completions.create(model=self.model, messages=messages, **params)
+        message = self._to_assistant_message(response)
+        await self._acache_completion(messages, params, message, response.usage)
+        return message, response.usage
+
+    def _call_llm_streaming(self, messages: list[dict], **params) -> tuple[dict, CompletionUsage | None, dict[Future, ToolCall]]:
+        """
+        Stream the LLM output and dispatch each tool call the moment it is
+        complete, so slow tools overlap with the rest of the generation.
+        Returns the assistant message, usage and the already-dispatched tool calls.
+        """
+        cached = self._get_cached_completion(messages, params)
+        if cached:
+            # Nothing to overlap with: tool calls are dispatched as usual after parsing
+            return *cached, {}
+        stream = self._client.chat.completions.create(
+            model=self.model, messages=messages, stream=True, stream_options={"include_usage": True}, **params
+        )
+        accumulator = CompletionStreamAccumulator(native_tools=self.tool_mode == "native")
+        dispatched = {}
+        for chunk in stream:
+            for tool_call in accumulator.feed(chunk):
+                # Batched tools and dependent calls wait for the full step
+                if self._can_dispatch_early(tool_call):
+                    dispatched[self._submit_tool_call(tool_call)] = tool_call
+        for tool_call in accumulator.finish():
+            if self._can_dispatch_early(tool_call):
+                dispatched[self._submit_tool_call(tool_call)] = tool_call
+        message = accumulator.message()
+        self._cache_completion(messages, params, message, accumulator.usage)
+        return message, accumulator.usage, dispatched
+
+    async def _acall_llm_streaming(self, messages: list[dict], **params) -> tuple[dict, CompletionUsage | None, dict[Future, ToolCall]]:
+        cached = await self._aget_cached_completion(messages, params)
+        if cached:
+            return *cached, {}
+        stream = await self._async_client.chat.completions.create(
+            model=self.model, messages=messages, stream=True, stream_options={"include_usage": True}, **params
+        )
+        accumulator = CompletionStreamAccumulator(native_tools=self.tool_mode == "native")
+        dispatched = {}
+        async for chunk in stream:
+            for tool_call in accumulator.feed(chunk):
+                # Batched tools and dependent calls wait for the full step
+                if self._can_dispatch_early(tool_call):
+                    dispatched[self._submit_tool_call(tool_call, asyncio.get_running_loop())] = tool_call
+        for tool_call in accumulator.finish():
+            if self._can_dispatch_early(tool_call):
+                dispatched[self._submit_tool_call(tool_call, asyncio.get_running_loop())] = tool_call
+        message = accumulator.message()
+        await self._acache_completion(messages, params, message, accumulator.usage)
+        return message, accumulator.usage, dispatched
+
+    def _call_llm_step(self, session: Session) -> tuple[dict, CompletionUsage | None, dict[Future, ToolCall]]:
+        tool_names = self._selected_tools()
+        messages, params = self._build_messages(session, tool_names), self._completion_params(tool_names)
+        if self.stream:
+            return self._call_llm_streaming(messages, **params)
+        return *self._call_llm(messages, **params), {}
+
+    async def _acall_llm_step(self, session: Session) -> tuple[dict, CompletionUsage | None, dict[asyncio.Future, ToolCall]]:
+        tool_names = self._selected_tools()
+        messages, params = self._build_messages(session, tool_names), self._completion_params(tool_names)
+        if self.stream:
+            return await self._acall_llm_streaming(messages, **params)
+        return *await self._acall_llm(messages, **params), {}
+
+    def _format_tool_results(self, tool_call_results: list[dict], title: str = "Tool call results") -> str:
+        return f"{title}:\n{self.prompt_encoder.encode(tool_call_results)}"
+
+    def _format_rejected_step(self, error_message: str, tool_call_results: list[dict]) -> str:
+        """Error feedback for an invalid reply whose streamed tool calls were already executed."""
+        already_ran = self._format_tool_results(
+            tool_call_results, "These tool calls from the invalid response were already executed, do not repeat them"
+        )
+        return f"{error_message}\n\n{already_ran}"
+
+    def _build_tool_result_messages(self, tool_call_results: list[dict]) -> list[dict]:
+        if self.tool_mode == "native":
+            # The API expects one "tool" message per tool call, matched by id
+            return [
+                dict(role="tool", tool_call_id=tool_call_result["id"], content=tool_call_result["result"])
+                for tool_call_result in tool_call_results
+            ]
+        return [dict(role="user", content=self._format_tool_results(tool_call_results))]
+
+    def _submit_tool_call(self, tool_call: ToolCall, loop: asyncio.AbstractEventLoop | None = None) -> Future:
+        self._add_tools([tool_call.name])
+        future = self._tool_registry.submit(
+            tool_call.name, tool_call.parameters, self._tool_executor, loop, _current_session_id.get()
+        )
+        self._emit_on_done(future, "tool_call", tool_call_id=tool_call.id, tool_name=tool_call.name)
+        return future
+
+    def _submit_tool_calls(self, tool_calls: list[ToolCall], loop: asyncio.AbstractEventLoop | None = None) -> list[Future]:
+        """
+        Submit a step's tool calls, coalescing calls of the same tool into one
+        batched invocation. Returns one future per tool call, in order.
+        Async tools run on `loop` if given (arun passes its own loop).
+        """
+        indexes_by_name: dict[str, list[int]] = {}
+        for index, tool_call in enumerate(tool_calls):
+            indexes_by_name.setdefault(tool_call.name, []).append(index)
+        self._add_tools(list(indexes_by_name))
+        futures: list[Future | None] = [None] * len(tool_calls)
+        for name, indexes in indexes_by_name.items():
+            batch = self._tool_registry.submit_batch(
+                name, [tool_calls[index].parameters for index in indexes], self._tool_executor, loop,
+                _current_session_id.get()
+            )
+            for index, future in zip(indexes, batch):
+                self._emit_on_done(
+                    future, "tool_call", tool_call_id=tool_calls[index].id, tool_name=name, batch_size=len(indexes)
                 )
-        return f"Tool call results: {json.dumps(tool_call_results, indent=2)}"
+                futures[index] = future
+        return futures
+
+    def _can_dispatch_early(self, tool_call: ToolCall) -> bool:
+        """Whether a streamed tool call can start before the reply is complete."""
+        if tool_call.dependencies:
+            return False
+        tool = self._tool_registry.get(tool_call.name)
+        return tool is None or tool.batch_function is None
+
+    def _tool_call_deadline(self, tool_call: ToolCall, submitted_at: float, step_start: float) -> float | None:
+        """The tighter of the tool's own timeout (from submission) and the step-wide tool_timeout."""
+        tool = self._tool_registry.get(tool_call.name)
+        deadlines = []
+        if tool is not None and tool.timeout is not None:
+            deadlines.append(submitted_at + tool.timeout)
+        if self.tool_timeout is not None:
+            deadlines.append(step_start + self.tool_timeout)
+        return min(deadlines) if deadlines else None
+
+    def _cancel_tool_call(self, tool_call: ToolCall, future: Future):
+        """Stop a timed-out call where possible: queued calls are cancelled, running process calls killed."""
+        if future.cancel() or future.done():
+            return
+        tool = self._tool_registry.get(tool_call.name)
+        if tool is not None and tool.backend == "process" and tool.batch_function is None:
+            # A worker process can't be interrupted, only killed (without failing other calls)
+            self._tool_executor.terminate_process_call(future)
+        # A running thread can't be stopped; it finishes in the background and its result is dropped
+
+    @staticmethod
+    def _tool_result(tool_call: ToolCall, future: Future) -> dict:
+        try:
+            result = future.result()
+        except Exception as e:
+            # e.g. the process pool was terminated under a call
+            result = ToolError(f"Tool call failed: {e!r}")
+        return {"id": tool_call.id, "result": result}
+
+    @staticmethod
+    def _timeout_result(tool_call: ToolCall, timeout: float) -> dict:
+        return {
+            "id": tool_call.id,
+            "result": ToolError(f"Tool call timed out after {round(timeout, 3)}s"),
+            "status": "timeout",
+        }
+
+    @staticmethod
+    def _skipped_result(tool_call: ToolCall, reason: str) -> dict:
+        return {"id": tool_call.id, "result": ToolError(f"Tool call skipped: {reason}"), "status": "skipped"}
+
+    def _schedule_tool_calls(self, tool_calls: list[ToolCall], dispatched: dict[Future, ToolCall] | None) -> ToolCallSchedule:
+        # Tool calls already started while streaming are reused, not executed twice
+        start = time.monotonic()
+        running = {
+            future: tool_call for future, tool_call in (dispatched or {}).items()
+            if tool_call in tool_calls
+        }
+        return ToolCallSchedule(
+            start=start,
+            ids={tool_call.id for tool_call in tool_calls},
+            waiting=[tool_call for tool_call in tool_calls if tool_call not in running.values()],
+            running=running,
+            submitted_at={future: start for future in running},
+            deadlines={future: self._tool_call_deadline(tool_call, start, start) for future, tool_call in running.items()},
+        )
+
+    def _start_ready_tool_calls(self, schedule: ToolCallSchedule, loop: asyncio.AbstractEventLoop | None = None):
+        """Submit every waiting call whose dependencies have finished, resolving their result references."""
+        ready, waiting, skipped = [], [], False
+        for tool_call in schedule.waiting:
+            dependencies = tool_call.dependencies
+            unknown = [dependency for dependency in dependencies if dependency not in schedule.ids or dependency == tool_call.id]
+            failed = [
+                dependency for dependency in dependencies
+                if dependency in schedule.finished and isinstance(schedule.finished[dependency]["result"], ToolError)
+            ]
+            if unknown or failed:
+                reason = f"unknown dependency {unknown[0]}" if unknown else f"dependency {failed[0]} failed"
+                schedule.finished[tool_call.id] = self._skipped_result(tool_call, reason)
+                skipped = True
+            elif all(dependency in schedule.finished for dependency in dependencies):
+                try:
+                    ready.append(tool_call.resolve({
+                        dependency: schedule.finished[dependency]["result"] for dependency in dependencies
+                    }))
+                except (KeyError, IndexError, TypeError, ValueError, SyntaxError) as e:
+                    schedule.finished[tool_call.id] = self._skipped_result(tool_call, f"invalid result reference: {e!r}")
+                    skipped = True
+            else:
+                waiting.append(tool_call)
+        schedule.waiting = waiting
+        if not ready and not schedule.running and not skipped:
+            # Nothing can make progress: the remaining calls depend on each other
+            for tool_call in schedule.waiting:
+                schedule.finished[tool_call.id] = self._skipped_result(tool_call, "dependency cycle")
+            schedule.waiting = []
+
+        now = time.monotonic()
+        for future, tool_call in zip(self._submit_tool_calls(ready, loop), ready):
+            schedule.running[future] = tool_call
+            schedule.submitted_at[future] = now
+            schedule.deadlines[future] = self._tool_call_deadline(tool_call, now, schedule.start)
+
+    def _finish_tool_calls(self, schedule: ToolCallSchedule):
+        """Collect finished calls, and time out the ones past their deadline."""
+        now = time.monotonic()
+        for future, tool_call in list(schedule.running.items()):
+            deadline = schedule.deadlines[future]
+            if future.done():
+                schedule.finished[tool_call.id] = self._tool_result(tool_call, future)
+            elif deadline is not None and deadline <= now:
+                self._cancel_tool_call(tool_call, future)
+                schedule.finished[tool_call.id] = self._timeout_result(tool_call, deadline - schedule.submitted_at[future])
+            else:
+                continue
+            del schedule.running[future], schedule.deadlines[future]
+
+    @staticmethod
+    def _time_to_deadline(schedule: ToolCallSchedule, result_deadline: float | None = None) -> float | None:
+        deadlines = [deadline for deadline in schedule.deadlines.values() if deadline is not None]
+        if result_deadline is not None:
+            deadlines.append(result_deadline)
+        return max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+
+    def _drive_tool_calls(self, schedule: ToolCallSchedule, result_deadline: float | None = None):
+        """Run the schedule until every call has finished, or until result_deadline."""
+        while schedule.waiting or schedule.running:
+            self._start_ready_tool_calls(schedule)
+            if schedule.running:
+                wait(
+                    schedule.running, timeout=self._time_to_deadline(schedule, result_deadline),
+                    return_when=FIRST_COMPLETED
+                )
+                self._finish_tool_calls(schedule)
+            if result_deadline is not None and time.monotonic() >= result_deadline:
+                break
+
+    async def _adrive_tool_calls(self, schedule: ToolCallSchedule, result_deadline: float | None = None):
+        wrapped: dict[Future, asyncio.Future] = {}
+        while schedule.waiting or schedule.running:
+            self._start_ready_tool_calls(schedule, asyncio.get_running_loop())
+            if schedule.running:
+                for future in schedule.running:
+                    if future not in wrapped:
+                        wrapped[future] = asyncio.wrap_future(future)
+                        # Results are read from the concurrent future; mark the wrapper's as retrieved
+                        wrapped[future].add_done_callback(lambda done: done.cancelled() or done.exception())
+                await asyncio.wait(
+                    [wrapped[future] for future in schedule.running],
+                    timeout=self._time_to_deadline(schedule, result_deadline), return_when=asyncio.FIRST_COMPLETED
+                )
+                self._finish_tool_calls(schedule)
+            if result_deadline is not None and time.monotonic() >= result_deadline:
+                break
+
+    def _result_deadline(self, schedule: ToolCallSchedule) -> float | None:
+        return None if self.tool_result_deadline is None else schedule.start + self.tool_result_deadline
+
+    def _collect_tool_results(self, schedule: ToolCallSchedule) -> list[dict]:
+        """
+        Results finished but not yet delivered. Calls still in progress get a
+        "pending" entry and are kept for delivery in a later turn.
+        """
+        tool_call_results = [
+            result for tool_call_id, result in schedule.finished.items() if tool_call_id not in schedule.delivered
+        ]
+        schedule.delivered.update(result["id"] for result in tool_call_results)
+        pending_calls = list(schedule.running.values()) + schedule.waiting
+        if pending_calls:
+            self._late_tool_calls.setdefault(_current_session_id.get(), []).append(schedule)
+            tool_call_results += [
+                {
+                    "id": tool_call.id,
+                    "result": "Still running, the result will follow in a later message with this id",
+                    "status": "pending",
+                }
+                for tool_call in pending_calls
+            ]
+        return tool_call_results
+
+    def _spill_tool_results(self, tool_call_results: list[dict]) -> list[dict]:
+        """Move large results to the result store, leaving a preview and a handle."""
+        if self.result_store is None:
+            return tool_call_results
+        return [{**result, "result": self.result_store.spill(result["result"])} for result in tool_call_results]
+
+    async def _aspill_tool_results(self, tool_call_results: list[dict]) -> list[dict]:
+        if self.result_store is None:
+            return tool_call_results
+        # Hashing and writing large results happens in a thread, off the event loop
+        return await asyncio.to_thread(self._spill_tool_results, tool_call_results)
+
+    def _execute_tools_parallel(
+            self, tool_calls: list[ToolCall], dispatched: dict[Future, ToolCall] | None = None
+        ) -> list[dict]:
+        """
+        Run a step's tool calls with maximum parallelism: independent calls start
+        at once, dependent calls as soon as everything they depend on has finished.
+        Results are in completion order.
+        """
+        schedule = self._schedule_tool_calls(tool_calls, dispatched)
+        self._drive_tool_calls(schedule, self._result_deadline(schedule))
+        return self._spill_tool_results(self._collect_tool_results(schedule))
+
+    async def _aexecute_tools_parallel(
+            self, tool_calls: list[ToolCall], dispatched: dict[Future, ToolCall] | None = None
+        ) -> list[dict]:
+        schedule = self._schedule_tool_calls(tool_calls, dispatched)
+        await self._adrive_tool_calls(schedule, self._result_deadline(schedule))
+        return await self._aspill_tool_results(self._collect_tool_results(schedule))
+
+    def _late_tool_results(self, wait_all: bool = False) -> list[dict]:
+        """Results of earlier steps' stragglers finished since, optionally waiting for all of them."""
+        tool_call_results = []
+        schedules = self._late_tool_calls.pop(_current_session_id.get(), [])
+        for schedule in schedules:
+            self._drive_tool_calls(schedule, None if wait_all else time.monotonic())
+            tool_call_results += self._collect_tool_results(schedule)
+        return self._spill_tool_results(
+            [result for result in tool_call_results if result.get("status") != "pending"]
+        )
+
+    def _drop_late_tool_calls(self):
+        """Give up on stragglers still pending when a run ends (e.g. max steps reached or an error)."""
+        for schedule in self._late_tool_calls.pop(_current_session_id.get(), []):
+            for future, tool_call in schedule.running.items():
+                self._cancel_tool_call(tool_call, future)
+
+    async def _alate_tool_results(self, wait_all: bool = False) -> list[dict]:
+        tool_call_results = []
+        schedules = self._late_tool_calls.pop(_current_session_id.get(), [])
+        for schedule in schedules:
+            await self._adrive_tool_calls(schedule, None if wait_all else time.monotonic())
+            tool_call_results += self._collect_tool_results(schedule)
+        return await self._aspill_tool_results(
+            [result for result in tool_call_results if result.get("status") != "pending"]
+        )
+
+    def _deliver_late_tool_results(self, step: int, session: Session, wait_all: bool = False) -> bool:
+        late_results = self._late_tool_results(wait_all)
+        if late_results:
+            content = self._format_tool_results(late_results, title="Late tool call results")
+            self._persist(session, role="user", content=content)
+            print(f"[Step {step + 1}] {content}\n")
+        return bool(late_results)
+
+    async def _adeliver_late_tool_results(self, step: int, session: Session, wait_all: bool = False) -> bool:
+        late_results = await self._alate_tool_results(wait_all)
+        if late_results:
+            content = self._format_tool_results(late_results, title="Late tool call results")
+            await self._apersist(session, role="user", content=content)
+            print(f"[Step {step + 1}] {content}\n")
+        return bool(late_results)
+
+    def _parse_llm_output(self, step: int, message: dict) -> tuple[LLMOutput | None, str | None]:
+        """Turn the assistant message into an LLMOutput, returning (response, None) or (None, error feedback)."""
+        if self.tool_mode == "native":
+            # Structured tool calls from the API: nothing to parse, nothing to get wrong
+            content = [Message(text=message["content"])] if message["content"] else []
+            content += [native_to_tool_call(tool_call) for tool_call in message.get("tool_calls", [])]
+            response = LLMOutput(content=content)
+        else:
+            try:
+                response = LLMOutput.model_validate_json(message["content"])
+            except Exception as e:
+                error_message = f"Invalid response format: {e}"
+                print(f"[Step {step + 1}] {error_message}\n")
+                return None, error_message
+
+        # Print agent response
+        for response_item in response.content:
+            if isinstance(response_item, Message):
+                print(f"[Step {step + 1}] Agent (message):\n\t{response_item.model_dump_json(indent=2)}")
+            else:
+                print(f"[Step {step + 1}] Agent (tool_call):\n\t{response_item.model_dump_json(indent=2)}")
+        return response, None
+
+    def _record_usage(self, attributes: dict, usage: CompletionUsage | None):
+        if usage is not None:
+            attributes.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
 
     def run(self, user_query, session: Session | None = None) -> str:
         if not session:
             session = Session()
-        session.add_message(role="user", content=user_query)
+        run_token = _current_run_id.set(str(uuid.uuid4()))
+        session_token = _current_session_id.set(session.id)
+        tools_token = _current_tools.set(self._select_tools(user_query, session))
+        try:
+            with self._timed("run", session_id=session.id):
+                return self._run(user_query, session)
+        finally:
+            self._drop_late_tool_calls()
+            _current_step.set(None)
+            _current_tools.reset(tools_token)
+            _current_session_id.reset(session_token)
+            _current_run_id.reset(run_token)
+
+    def _run(self, user_query, session: Session) -> str:
+        self._persist(session, role="user", content=user_query)
 
         for step in range(self.max_steps):
-            llm_output, usage = self._call_llm(self._build_messages(session))
-            # Compact AFTER detecting over-limit, not before. This works because:
-            # 1. max_prompt_tokens is a soft limit we set, below the model's hard limit
-            # 2. The call succeeded, but we're approaching the limit — compact for NEXT iteration
-            # 3. The response (llm_output) is still valid and gets added below
-            if self._is_over_limit(usage):
-                print(f"[Step {step + 1}] Context is over the limit, compacting for next iteration")
-                self._compact_session(session)
-            session.add_message(role="assistant", content=llm_output)
+            _current_step.set(step + 1)
+            with self._timed("step"):
+                self._deliver_late_tool_results(step, session)
+                # Proactive check with the local estimate: compact BEFORE paying for an oversized call
+                if self._is_estimated_over_limit(session):
+                    print(f"[Step {step + 1}] Estimated context is over the limit, compacting before the call")
+                    self._compact_session(session)
+                # Right before the call, so the context limit guard sees exactly what will be sent
+                self._swap_in_compaction(step, session)
+                with self._timed("llm_call", model=self.model) as llm_attributes:
+                    llm_message, usage, dispatched = self._call_llm_step(session)
+                    self._record_usage(llm_attributes, usage)
+                # Compact AFTER detecting over-limit, not before. This works because:
+                # 1. max_prompt_tokens is a soft limit we set, below the model's hard limit
+                # 2. The call succeeded, but we're approaching the limit — compact for NEXT iteration
+                # 3. The response (llm_message) is still valid and gets added below
+                if self._is_over_limit(session, usage):
+                    print(f"[Step {step + 1}] Context is over the limit, compacting for next iteration")
+                    self._compact_session(session)
+                self._persist(session, **llm_message)
 
-            try:
-                response = LLMOutput.model_validate_json(llm_output)
-            except Exception as e:
-                error_message = f"Invalid response format: {e}"
-                session.add_message(role="user", content=error_message)
+                with self._timed("parse"):
+                    response, error_message = self._parse_llm_output(step, llm_message)
+                if response is None:
+                    if dispatched:
+                        # Streamed tool calls already ran: report them so the retry doesn't repeat them
+                        with self._timed("tools", count=len(dispatched)):
+                            tool_call_results = self._execute_tools_parallel(list(dispatched.values()), dispatched)
+                        error_message = self._format_rejected_step(error_message, tool_call_results)
+                    self._persist(session, role="user", content=error_message)
+                    continue
 
-                print(f"[Step {step + 1}] {error_message}\n")
-                continue
+                returned_tool_calls = [
+                    response_item for response_item in response.content
+                    if isinstance(response_item, ToolCall)
+                ]
+                returned_messages = [
+                    response_item for response_item in response.content
+                    if isinstance(response_item, Message)
+                ]
 
-            returned_tool_calls = [
-                response_item for response_item in response.content
-                if isinstance(response_item, ToolCall)
-            ]
-            returned_messages = [
-                response_item for response_item in response.content
-                if isinstance(response_item, Message)
-            ]
+                if returned_tool_calls:
+                    with self._timed("tools", count=len(returned_tool_calls)):
+                        tool_call_results = self._execute_tools_parallel(returned_tool_calls, dispatched)
+                    for tool_result_message in self._build_tool_result_messages(tool_call_results):
+                        self._persist(session, **tool_result_message)
 
-            # Print agent response
-            for response_item in response.content:
-                if isinstance(response_item, Message):
-                    print(f"[Step {step + 1}] Agent (message):\n\t{response_item.model_dump_json(indent=2)}")
+                    print(f"[Step {step + 1}] Tool results:\n{'-' * 10}\n{self._format_tool_results(tool_call_results)}\n{'-' * 10}\n")
+                elif self._deliver_late_tool_results(step, session, wait_all=True):
+                    # Not done yet: the model answers again with the stragglers' results
+                    continue
                 else:
-                    print(f"[Step {step + 1}] Agent (tool_call):\n\t{response_item.model_dump_json(indent=2)}")
+                    final_response = "\n".join(msg.text for msg in returned_messages)
+                    return final_response
+        return "Max step reached"
 
-            if returned_tool_calls:
-                tool_call_results = self._execute_tools_parallel(returned_tool_calls)
-                session.add_message(role="user", content=tool_call_results)
+    async def arun(self, user_query, session: Session | None = None) -> str:
+        """
+        Async version of run(): same step limit, compaction and error feedback,
+        but the LLM call, tool calls and session I/O never block the event loop,
+        so one loop can drive many sessions concurrently.
+        """
+        if not session:
+            session = Session()
+        run_token = _current_run_id.set(str(uuid.uuid4()))
+        session_token = _current_session_id.set(session.id)
+        tools_token = _current_tools.set(self._select_tools(user_query, session))
+        try:
+            with self._timed("run", session_id=session.id):
+                return await self._arun(user_query, session)
+        finally:
+            self._drop_late_tool_calls()
+            _current_step.set(None)
+            _current_tools.reset(tools_token)
+            _current_session_id.reset(session_token)
+            _current_run_id.reset(run_token)
 
-                print(f"[Step {step + 1}] Tool results:\n{'-' * 10}\n{tool_call_results}\n{'-' * 10}\n")
-            else:
-                final_response = "\n".join(msg.text for msg in returned_messages)
-                return final_response
+    async def _arun(self, user_query, session: Session) -> str:
+        await self._apersist(session, role="user", content=user_query)
+
+        for step in range(self.max_steps):
+            _current_step.set(step + 1)
+            with self._timed("step"):
+                await self._adeliver_late_tool_results(step, session)
+                if self._is_estimated_over_limit(session):
+                    print(f"[Step {step + 1}] Estimated context is over the limit, compacting before the call")
+                    await self._acompact_session(session)
+                await self._aswap_in_compaction(step, session)
+                with self._timed("llm_call", model=self.model) as llm_attributes:
+                    llm_message, usage, dispatched = await self._acall_llm_step(session)
+                    self._record_usage(llm_attributes, usage)
+                if self._is_over_limit(session, usage):
+                    print(f"[Step {step + 1}] Context is over the limit, compacting for next iteration")
+                    await self._acompact_session(session)
+                await self._apersist(session, **llm_message)
+
+                with self._timed("parse"):
+                    response, error_message = self._parse_llm_output(step, llm_message)
+                if response is None:
+                    if dispatched:
+                        with self._timed("tools", count=len(dispatched)):
+                            tool_call_results = await self._aexecute_tools_parallel(list(dispatched.values()), dispatched)
+                        error_message = self._format_rejected_step(error_message, tool_call_results)
+                    await self._apersist(session, role="user", content=error_message)
+                    continue
+
+                returned_tool_calls = [
+                    response_item for response_item in response.content
+                    if isinstance(response_item, ToolCall)
+                ]
+                returned_messages = [
+                    response_item for response_item in response.content
+                    if isinstance(response_item, Message)
+                ]
+
+                if returned_tool_calls:
+                    with self._timed("tools", count=len(returned_tool_calls)):
+                        tool_call_results = await self._aexecute_tools_parallel(returned_tool_calls, dispatched)
+                    for tool_result_message in self._build_tool_result_messages(tool_call_results):
+                        await self._apersist(session, **tool_result_message)
+
+                    print(f"[Step {step + 1}] Tool results:\n{'-' * 10}\n{self._format_tool_results(tool_call_results)}\n{'-' * 10}\n")
+                elif await self._adeliver_late_tool_results(step, session, wait_all=True):
+                    continue
+                else:
+                    final_response = "\n".join(msg.text for msg in returned_messages)
+                    return final_response
         return "Max step reached"
 
 
@@ -162,6 +1097,18 @@ def get_weather(location: str) -> str:
         raise Exception("Unknown location: supported locations are 'los angeles' and 'beijing'")
 
 
+def get_weather_batch(parameters_list: list[dict]) -> list:
+    """get weather for several locations in one backend request
+    """
+    results = []
+    for parameters in parameters_list:
+        try:
+            results.append(get_weather(**parameters))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 class GetWeatherParameters(BaseModel):
     location: str = Field(description="The city name to get weather for")
 
@@ -208,6 +1155,9 @@ if __name__ == "__main__":
         {
             "function": get_weather,
             "parameters": GetWeatherParameters,
+            "batch_function": get_weather_batch,
+            "cache": True,
+            "cache_ttl": 600,
         },
         {
             "function": send_email,
@@ -218,7 +1168,12 @@ if __name__ == "__main__":
             "parameters": GetUserProfileParameters
         }
     ]
-    agent = Agent(tools, max_prompt_tokens=5000)
+    latency_collector = LatencyCollector()
+    trace_exporter = TraceExporter("./traces/agent_traces.jsonl")
+    agent = Agent(
+        tools, max_prompt_tokens=5000, max_tool_workers=4, tool_cache=ToolCache(), tool_timeout=30,
+        hooks=[latency_collector, trace_exporter]
+    )
 
     user_query = "How is the weather in Beijing and LA?"
     session = FileSession(session_dir="./sessions")
@@ -241,3 +1196,11 @@ if __name__ == "__main__":
     print("========Session History========")
     print(json.dumps(session.get_messages(), indent=2))
     print("===============================")
+
+    print("========Latency (ms)========")
+    print(latency_collector.dump())
+    print("============================")
+
+    agent.close()
+    trace_exporter.flush()
+    print(f"Traces written to {trace_exporter.path}")